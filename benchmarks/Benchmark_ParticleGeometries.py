@@ -0,0 +1,243 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+
+from functions.utils.Profiler import Profiler, process_peak_memory  # noqa: E402
+
+"""
+Benchmark suite of the clump generators and ExtractSurface over the bundled particle geometries
+
+The main concept of this functionality:
+1. A matrix of benchmark cases is built: each generator is run on every geometry of examples/ParticleGeometries for
+   a set of parameters, and ExtractSurface is run on clumps of increasing size.
+2. Each case runs in a fresh process, so that its peak memory is not hidden by the memory of previous cases.
+3. The wall time, the peak memory, the duration of each stage (see functions.utils.Profiler) and the number of
+   generated spheres of each case are recorded to a .json file, together with the commit and the versions of the
+   environment.
+4. Two results files (e.g. of two commits) can be compared, reporting the cases which became slower or heavier
+   beyond a threshold, or whose number of spheres changed.
+
+Usage, from the root of the repository:
+    python benchmarks/Benchmark_ParticleGeometries.py --output results.json [--quick] [--filter Torus] [--repeat 3]
+    python benchmarks/Benchmark_ParticleGeometries.py --compare old.json new.json [--threshold 1.2]
+"""
+
+GEOMETRIES = ["Hexahedron_Coarse_Mesh.stl", "Hexahedron_Fine_Mesh.stl", "Octahedron_Coarse_Mesh.stl",
+              "Octahedron_Fine_Mesh.stl", "Ellipsoid_R_2.0_1.0_0.5.stl", "Ellipsoid_R_2.0_1.0_1.0.stl", "Torus.stl",
+              "Human_femur.stl"]
+
+# Parameter matrix of each generator: (full, quick). The lengths of Ferellec-McDowell are relative to the shortest
+# edge of the AABB of each particle, so that the same matrix suits particles of any size.
+EUCLIDEAN = ([dict(N=20, rMin=0, div=div, overlap=0.5) for div in (30, 60)],
+             [dict(N=20, rMin=0, div=30, overlap=0.5)])
+FAVIER = ([dict(N=N, chooseDistance="min") for N in (10, 20)],
+          [dict(N=10, chooseDistance="min")])
+FERELLEC_MCDOWELL = ([dict(dmin=0.05, rmin=0.01, rstep=0.01, pmax=0.8, seed=5, exactRadius=exact)
+                      for exact in (False, True)],
+                     [dict(dmin=0.05, rmin=0.01, rstep=0.01, pmax=0.8, seed=5, exactRadius=True)])
+
+# ExtractSurface is run on chains of spheres, each one overlapping its neighbours only
+EXTRACT_SURFACE = ([dict(numSpheres=n, N_sphere=N_sphere, N_circle=100) for n in (10, 50) for N_sphere in (200, 800)],
+                   [dict(numSpheres=10, N_sphere=200, N_circle=100)])
+
+
+def buildCases(quick=False):
+    """
+    :param quick: If True, a reduced parameter matrix is used
+    :return: list of cases, each one a dict with the name, function, geometry and parameters of the case
+    """
+    level = 1 if quick else 0
+    cases = []
+
+    for geometry in GEOMETRIES:
+        for function, matrix in (("Euclidean_3D", EUCLIDEAN), ("Favier", FAVIER),
+                                 ("Ferellec_McDowell", FERELLEC_MCDOWELL)):
+            for parameters in matrix[level]:
+                cases.append(dict(function=function, geometry=geometry, parameters=parameters))
+
+    for parameters in EXTRACT_SURFACE[level]:
+        cases.append(dict(function="ExtractSurface", geometry=None, parameters=parameters))
+
+    for case in cases:
+        case["name"] = "/".join([case["function"], case["geometry"] or "chain",
+                                 ",".join(f"{k}={v}" for k, v in case["parameters"].items())])
+
+    return cases
+
+
+def runCase(case, repeat=1):
+    """
+    Run one benchmark case. It is meant to be called in a fresh process.
+
+    :return: dict with the wall time (minimum over the repetitions), the increase of the peak memory of the process
+             and the duration of each stage during the first repetition, and the number of spheres (or of vertices
+             and faces for ExtractSurface)
+    """
+    from functions.ExtractSurface import ExtractSurface
+    from functions.GenerateClump_Euclidean_3D import GenerateClump_Euclidean_3D
+    from functions.GenerateClump_Favier import GenerateClump_Favier
+    from functions.GenerateClump_Ferellec_McDowell import GenerateClump_Ferellec_McDowell
+    from functions.utils.STLReader import read_stl
+
+    parameters = dict(case["parameters"])
+
+    if case["function"] == "ExtractSurface":
+        n = parameters.pop("numSpheres")
+        clump = np.column_stack((np.arange(n) * 1.5, np.zeros(n), np.zeros(n), np.ones(n)))
+
+        def run(profiler):
+            return ExtractSurface(clump, parameters["N_sphere"], parameters["N_circle"], False, profiler)
+    else:
+        inputGeom = os.path.join(ROOT, "examples", "ParticleGeometries", case["geometry"])
+
+        if case["function"] == "Euclidean_3D":
+            generator = GenerateClump_Euclidean_3D
+        elif case["function"] == "Favier":
+            generator = GenerateClump_Favier
+        else:
+            generator = GenerateClump_Ferellec_McDowell
+            _, P = read_stl(inputGeom)
+            scale = np.min(np.max(P, axis=0) - np.min(P, axis=0))
+            for key in ("dmin", "rmin", "rstep"):
+                parameters[key] *= scale
+
+        def run(profiler):
+            return generator(inputGeom, profiler=profiler, **parameters)
+
+    wallTimes = []
+    before = process_peak_memory()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for _ in range(repeat):
+            start = time.perf_counter()
+            profiler = Profiler()
+            result = run(profiler)
+            wallTimes.append(time.perf_counter() - start)
+            if len(wallTimes) == 1:
+                after = process_peak_memory()
+                stages = profiler.summary()
+
+    record = dict(wallTime=min(wallTimes), peakMemory=None if before is None else after - before, stages=stages)
+    if case["function"] == "ExtractSurface":
+        faces, vertices = result
+        record.update(numVertices=int(len(vertices)), numFaces=int(len(faces)))
+    else:
+        record.update(numSpheres=int(result[1].numSpheres))
+
+    return record
+
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True,
+                                check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    import scipy
+    import trimesh
+
+    return dict(commit=commit, date=time.strftime("%Y-%m-%dT%H:%M:%S"), python=platform.python_version(),
+                numpy=np.__version__, scipy=scipy.__version__, trimesh=trimesh.__version__,
+                platform=platform.platform(), processor=platform.processor(), cpus=os.cpu_count())
+
+
+def runBenchmarks(output, quick=False, nameFilter=None, repeat=1):
+    """
+    Run the benchmark cases and write the results to a .json file. A case that fails is recorded with its error.
+
+    :param output: Path of the .json results file
+    :param quick: If True, a reduced parameter matrix is used
+    :param nameFilter: If given, only the cases whose name contains this string are run
+    :param repeat: Number of repetitions of each case; the minimum wall time is recorded
+    :return: results: dict with the environment and the list of the results of the cases
+    """
+    cases = [case for case in buildCases(quick) if nameFilter is None or nameFilter in case["name"]]
+    results = dict(environment=environment(), results=[])
+
+    for i, case in enumerate(cases):
+        record = dict(name=case["name"], function=case["function"], geometry=case["geometry"],
+                      parameters=case["parameters"])
+        with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as executor:
+            try:
+                record.update(executor.submit(runCase, case, repeat).result())
+            except Exception as error:
+                record["error"] = f"{type(error).__name__}: {error}"
+
+        results["results"].append(record)
+        print(f"[{i + 1}/{len(cases)}] {case['name']}: " +
+              (record["error"] if "error" in record else f"{record['wallTime']:.3f} s"))
+
+        # Written after every case, so that an interrupted run keeps its results
+        with open(output, "w") as file:
+            json.dump(results, file, indent=2)
+
+    return results
+
+
+def compareResults(old, new, threshold=1.2):
+    """
+    Compare two results files, e.g. of two commits.
+
+    :param old: Path of the reference .json results file
+    :param new: Path of the new .json results file
+    :param threshold: Ratio new/old of the wall time or peak memory above which a case is reported as a regression
+    :return: regressions: list of the names of the cases which regressed or whose output changed
+    """
+    with open(old) as file:
+        oldResults = {record["name"]: record for record in json.load(file)["results"]}
+    with open(new) as file:
+        newResults = {record["name"]: record for record in json.load(file)["results"]}
+
+    regressions = []
+    for name, record in newResults.items():
+        reference = oldResults.get(name)
+        if reference is None:
+            continue
+
+        messages = []
+        if "error" in record and "error" not in reference:
+            messages.append(record["error"])
+        for key in ("wallTime", "peakMemory"):
+            if reference.get(key) and record.get(key) is not None:
+                ratio = record[key] / reference[key]
+                if ratio > threshold:
+                    messages.append(f"{key} x{ratio:.2f}")
+        for key in ("numSpheres", "numVertices", "numFaces"):
+            if reference.get(key) != record.get(key):
+                messages.append(f"{key} {reference.get(key)} -> {record.get(key)}")
+
+        if messages:
+            regressions.append(name)
+            print(f"{name}: {', '.join(messages)}")
+
+    print(f"{len(regressions)} of {len(newResults)} cases regressed or changed.")
+
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the clump generators over the bundled particle geometries.")
+    parser.add_argument("--output", default="benchmark_results.json", help="Path of the .json results file")
+    parser.add_argument("--quick", action="store_true", help="Run a reduced parameter matrix")
+    parser.add_argument("--filter", default=None, help="Only run the cases whose name contains this string")
+    parser.add_argument("--repeat", type=int, default=1, help="Repetitions of each case (minimum wall time)")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="Compare two results files")
+    parser.add_argument("--threshold", type=float, default=1.2, help="Regression ratio for --compare")
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if compareResults(*args.compare, threshold=args.threshold) else 0)
+    else:
+        runBenchmarks(args.output, quick=args.quick, nameFilter=args.filter, repeat=args.repeat)
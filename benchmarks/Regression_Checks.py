@@ -0,0 +1,457 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import trimesh
+from scipy.ndimage import binary_dilation
+from scipy.spatial import Delaunay
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+GEOMETRIES = os.path.join(ROOT, "examples", "ParticleGeometries")
+
+from functions.ExtractSurface import contactDetection, sphereContact  # noqa: E402
+import functions.GenerateClump_Batch as GenerateClump_Batch_module  # noqa: E402
+from functions.GenerateClump_Batch import GenerateClump_Batch  # noqa: E402
+from functions.GenerateClump_Euclidean_3D import GenerateClump_Euclidean_3D, sphereBox, squaredEDT  # noqa: E402
+from functions.GenerateClump_Favier import GenerateClump_Favier  # noqa: E402
+from functions.GenerateClump_Ferellec_McDowell import GenerateClump_Ferellec_McDowell, tangentRadii  # noqa: E402
+from functions.utils import PatchNormals, STLReader  # noqa: E402
+from functions.utils.ClumpCache import ClumpCache  # noqa: E402
+from functions.utils.MaximumIndex import MaximumIndex  # noqa: E402
+from functions.utils.MyCrust.MyRobustCrust import (AddShield, CC, Connectivity, GroupIndices,  # noqa: E402
+                                                   IntersectionFactor, MarkingLevel, UniqueRows, matlab_delaunayn)
+from functions.utils.STLReader import load_stl_points  # noqa: E402
+from functions.utils.Voxeliser import voxelise  # noqa: E402
+
+"""
+Deterministic regression checks of the optimised code paths against the behaviour they replace
+
+Each check runs on small inputs (the bundled particle geometries or synthetic data) and raises an AssertionError if
+the optimised path and its reference disagree. The checks are cheap enough to run before every commit.
+
+Usage, from the root of the repository:
+    python benchmarks/Regression_Checks.py [--filter Batch]
+"""
+
+
+def killingGenerator(inputGeom, **kwargs):
+    """
+    Stand-in for a clump generator whose worker is killed (e.g. for running out of memory) on particles named
+    "*kill".
+    """
+    if inputGeom.endswith("kill"):
+        os._exit(9)
+
+    time.sleep(0.2)  # The other particles are still unfinished when the worker dies
+
+    return inputGeom, kwargs
+
+
+def checkBatchWorkerCrash():
+    """
+    GenerateClump_Batch: a dead worker only costs attempts to the particle which killed it, and the other particles
+    of the batch are resubmitted and finish.
+    """
+    inputGeoms = [f"particle{i}" for i in range(8)]
+    inputGeoms[3] += "kill"
+
+    results, failures = GenerateClump_Batch(inputGeoms, killingGenerator, processes=2, retries=2, N=1)
+
+    assert list(failures) == [inputGeoms[3]], f"failed particles: {list(failures)}"
+    assert "BrokenProcessPool" in failures[inputGeoms[3]]
+    for i, inputGeom in enumerate(inputGeoms):
+        if i != 3:
+            assert results[i] == (inputGeom, {"N": 1}), f"result of {inputGeom}: {results[i]}"
+    assert results[3] is None
+
+
+class BreakingExecutor(ProcessPoolExecutor):
+    """
+    Process pool whose workers are all killed just before its third submission, i.e. after a successful wait.
+    """
+    submissions = 0
+
+    def submit(self, *args, **kwargs):
+        BreakingExecutor.submissions += 1
+        if BreakingExecutor.submissions == 3:
+            for process in list(self._processes.values()):
+                process.kill()
+            while not self._broken:
+                time.sleep(0.01)
+
+        return super().submit(*args, **kwargs)
+
+
+def checkBatchBrokenSubmit():
+    """
+    GenerateClump_Batch: a pool which breaks between a wait and the next submission is rebuilt, and the particles
+    finish.
+    """
+    inputGeoms = [f"particle{i}" for i in range(6)]
+
+    BreakingExecutor.submissions = 0
+    GenerateClump_Batch_module.ProcessPoolExecutor = BreakingExecutor
+    try:
+        results, failures = GenerateClump_Batch(inputGeoms, killingGenerator, processes=2, retries=1, N=1)
+    finally:
+        GenerateClump_Batch_module.ProcessPoolExecutor = ProcessPoolExecutor
+
+    assert BreakingExecutor.submissions > 3, "the pool was not broken"
+    assert not failures, f"failed particles: {list(failures)}"
+    assert results == [(inputGeom, {"N": 1}) for inputGeom in inputGeoms], f"results: {results}"
+
+
+def checkCrustGrouping():
+    """
+    MyRobustCrust: UniqueRows matches np.unique(axis=0), GroupIndices matches a grouping loop, and Connectivity matches
+    the original loop over the tetrahedrons.
+    """
+    rng = np.random.default_rng(0)
+
+    rows = rng.integers(0, 40, size=(5000, 3))
+    t, j = UniqueRows(rows)
+    tRef, jRef = np.unique(rows, axis=0, return_inverse=True)
+    assert np.array_equal(t, tRef) and np.array_equal(j, jRef.ravel()), "UniqueRows differs from np.unique"
+
+    keys = rng.integers(0, 300, size=2000)
+    ptr, idx = GroupIndices(keys, 310)
+    for k in range(310):
+        assert np.array_equal(idx[ptr[k]:ptr[k + 1]], np.flatnonzero(keys == k)), f"GroupIndices differs for key {k}"
+
+    points = rng.random((400, 3))
+    tetr = Delaunay(points).simplices
+    t2tetr, tetr2t, t = Connectivity(tetr)
+
+    tetr2tRef = np.zeros((t.shape[0], 2), dtype=np.int32)
+    count = np.zeros(t.shape[0], dtype=int)
+    for k in range(tetr.shape[0]):
+        for ce in t2tetr[k]:
+            tetr2tRef[ce, count[ce]] = k
+            count[ce] += 1
+    faces = np.stack([tetr[:, [0, 1, 2]], tetr[:, [1, 2, 3]], tetr[:, [0, 2, 3]], tetr[:, [0, 1, 3]]], axis=1)
+    assert np.array_equal(t[t2tetr], np.sort(faces, axis=2)), "Connectivity gives wrong triangles"
+    assert np.array_equal(tetr2t, tetr2tRef), "Connectivity differs from the loop over the tetrahedrons"
+
+
+def markingLevelLoop(queue, tetr2t, t2tetr, Ifact, toll, TOLLDIFF, checked, deleted, onfront):
+    """
+    Reference for MarkingLevel: the original walk over the triangles of the queue, one after the other.
+    """
+    newlyChecked = 0
+    for id_ in queue:
+        tetr1, tetr2 = tetr2t[id_]
+
+        if tetr2 == 0 or (checked[tetr1] and checked[tetr2]):
+            onfront[id_] = False
+            continue
+
+        if Ifact[id_] >= toll[id_] or Ifact[id_] < -toll[id_]:
+            source, target = (tetr1, tetr2) if checked[tetr1] else (tetr2, tetr1)
+            deleted[target] = deleted[source] if Ifact[id_] >= toll[id_] else not deleted[source]
+            checked[target] = True
+            newlyChecked += 1
+            onfront[t2tetr[target]] = True
+            onfront[id_] = False
+        else:
+            toll[id_] -= TOLLDIFF
+
+    return newlyChecked
+
+
+def checkCrustMarking():
+    """
+    MyRobustCrust: every level of the walk of MarkingLevel gives the same state as the sequential walk over the front.
+    """
+    rng = np.random.default_rng(1)
+    points = rng.normal(size=(600, 3))
+    points /= np.linalg.norm(points, axis=1)[:, np.newaxis]
+    points *= 1 + 0.05 * rng.random((600, 1))  # A rough surface, so that some triangles are undecided
+
+    p, nshield = AddShield(points)
+    tetr = matlab_delaunayn(p)
+    t2tetr, tetr2t, t = Connectivity(tetr)
+    cc, r = CC(p, tetr)
+    Ifact = IntersectionFactor(tetr2t, cc, r).ravel()
+
+    deleted = np.any(tetr > p.shape[0] - nshield, axis=1)
+    checked = deleted.copy()
+    onfront = np.zeros(t.shape[0], dtype=bool)
+    onfront[t2tetr[checked].ravel()] = True
+    toll = np.full(t.shape[0], .99)
+    state = (toll, checked, deleted, onfront)
+
+    for level in range(1000):
+        if np.all(checked):
+            break
+
+        queue = np.flatnonzero(onfront)
+        reference = tuple(array.copy() for array in state)
+        newlyChecked = MarkingLevel(queue, tetr2t, t2tetr, Ifact, *state[:1], .01, *state[1:])
+        newlyCheckedRef = markingLevelLoop(queue, tetr2t, t2tetr, Ifact, *reference[:1], .01, *reference[1:])
+
+        assert newlyChecked == newlyCheckedRef, f"level {level}: {newlyChecked} flagged instead of {newlyCheckedRef}"
+        for name, array, arrayRef in zip(("toll", "checked", "deleted", "onfront"), state, reference):
+            assert np.array_equal(array, arrayRef), f"level {level}: {name} differs from the sequential walk"
+
+    assert np.all(checked), "the walk did not flag every tetrahedron"
+
+
+def checkSTLFormats():
+    """
+    load_stl_points: binary files with trailing bytes or a header starting with "solid" are read as binary, and ASCII
+    files are still parsed.
+    """
+    mesh = trimesh.creation.icosphere(2)
+    reference = mesh.vertices[mesh.faces].reshape(-1, 3)
+    binary = trimesh.exchange.stl.export_stl(mesh)
+    solidHeader = b"solid binary".ljust(80, b" ") + binary[80:]
+
+    files = {"binary": binary, "trailing": binary + bytes(7), "solidHeader": solidHeader,
+             "solidHeaderTrailing": solidHeader + b"end", "ascii": trimesh.exchange.stl.export_stl_ascii(mesh).encode()}
+
+    with tempfile.TemporaryDirectory() as directory:
+        for name, content in files.items():
+            path = os.path.join(directory, name + ".stl")
+            with open(path, "wb") as file:
+                file.write(content)
+
+            P = load_stl_points(path)
+            assert P.shape == reference.shape and np.allclose(P, reference, atol=1e-5), f"{name} STL read wrongly"
+
+
+def checkContactDetection():
+    """
+    ExtractSurface: contactDetection finds the pairs of sphereContact, in the same order, on spheres whose radii span
+    two orders of magnitude (e.g. Ferellec-McDowell clumps).
+    """
+    rng = np.random.default_rng(3)
+    spheres = np.column_stack((rng.random((300, 3)) * 5, 0.02 * 100 ** rng.random(300)))
+    spheres[:3, 3] = 0.5  # Equal radii
+
+    interactions, distances = contactDetection(spheres)
+    reference = [(i, j) for i in range(300) for j in range(i + 1, 300) if sphereContact(spheres[i], spheres[j])]
+
+    assert np.array_equal(interactions, np.array(reference).reshape(-1, 2)), "pairs differ from sphereContact"
+    centers = spheres[:, :3]
+    assert np.allclose(distances, np.linalg.norm(centers[interactions[:, 1]] - centers[interactions[:, 0]], axis=1))
+
+
+def checkExactRadius():
+    """
+    GenerateClump_Ferellec_McDowell: with dmin=0 and the same seed, both modes visit the same vertices, and the radius
+    of the rstep search is within rstep of the exact tangent radius. tangentRadii returns inf exactly for the vertices
+    on which the rstep search would never stop, i.e. which no other vertex lies in front of.
+    """
+    ellipsoid = os.path.join(GEOMETRIES, "Ellipsoid_R_2.0_1.0_0.5.stl")
+    rmin, rstep = 0.01, 0.01
+    _, stepped = GenerateClump_Ferellec_McDowell(ellipsoid, 0, rmin, rstep, 0.02, seed=7)
+    _, exact = GenerateClump_Ferellec_McDowell(ellipsoid, 0, rmin, rstep, 0.02, seed=7, exactRadius=True)
+
+    assert stepped.numSpheres == exact.numSpheres, "the two modes visited different vertices"
+    difference = stepped.radii - exact.radii
+    assert np.all(np.abs(difference) <= rstep), f"radii differ by up to {np.max(np.abs(difference))} > rstep"
+
+    # Outward normals at random vertices of a convex particle: no vertex lies in front of them
+    F, P = STLReader.read_stl(os.path.join(GEOMETRIES, "Octahedron_Fine_Mesh.stl"))
+    N = PatchNormals.patch_normals(F, P)
+    N[np.sum((P - np.mean(P, axis=0)) * N, axis=1) > 0] *= -1
+    N[np.random.default_rng(4).random(P.shape[0]) < 0.3] *= -1
+
+    # The rstep search stops once a vertex B is inside the sphere by the tolerance rmin/1000 of the generator, which
+    # happens for a large enough radius if and only if AB.n > sqrt(rmin/1000)*|AB|
+    tol = rmin / 1000
+    n = N / np.linalg.norm(N, axis=1)[:, np.newaxis]
+    stops = np.array([np.any((P - P[i]) @ n[i] > np.sqrt(tol) * np.linalg.norm(P - P[i], axis=1))
+                      for i in range(P.shape[0])])
+
+    radii = tangentRadii(P, N)
+    assert np.any(~stops) and np.any(stops)
+    assert np.array_equal(np.isinf(radii), ~stops), "inf radii differ from the vertices where the search never stops"
+
+
+def checkVoxelMesh():
+    """
+    GenerateClump_Euclidean_3D: the mesh of a voxelated image only holds its rigid body parameters, so the padded image
+    is freed once the distance map is computed.
+    """
+    image = np.zeros((20, 24, 28), dtype=bool)
+    image[3:17, 4:20, 5:23] = True
+    mesh, _ = GenerateClump_Euclidean_3D(image, 4, 0, 15, 0.3)
+
+    for name, value in vars(mesh).items():
+        assert np.size(value) < 100, f"the mesh holds an array of {np.size(value)} elements in {name}"
+
+
+def checkClumpCache():
+    """
+    ClumpCache: a cache hit rebuilds the same mesh (of each type) and clump as the generator, a corrupt entry is a
+    miss, and unseeded calls of a random generator are not cached.
+    """
+    image = np.zeros((20, 24, 28), dtype=bool)
+    image[3:17, 4:20, 5:23] = True
+    torus = os.path.join(GEOMETRIES, "Torus.stl")
+    calls = [(GenerateClump_Euclidean_3D, (torus, 4, 0, 15, 0.3), {}),
+             (GenerateClump_Euclidean_3D, (image, 4, 0, 15, 0.3), {}),
+             (GenerateClump_Favier, (torus, 10), {"chooseDistance": "avg"})]
+
+    with tempfile.TemporaryDirectory() as directory:
+        cache = ClumpCache(directory)
+        for generator, args, kwargs in calls:
+            mesh, clump = generator(*args, **kwargs)
+            cache.generate(generator, *args, **kwargs)
+            meshHit, clumpHit = cache.generate(generator, *args, **kwargs)
+
+            name = f"{generator.__name__} ({type(mesh).__name__})"
+            assert type(meshHit) is type(mesh), f"{name}: cached mesh of type {type(meshHit).__name__}"
+            assert np.array_equal(clumpHit.positions, clump.positions) and np.array_equal(clumpHit.radii, clump.radii)
+            for attribute in ("volume", "centroid", "inertia_tensor", "moment_inertia", "PAI", "eigs", "vertices", "P",
+                              "shape"):
+                if hasattr(mesh, attribute):
+                    assert np.allclose(getattr(meshHit, attribute), getattr(mesh, attribute)), f"{name}: {attribute}"
+
+        # A truncated entry is a miss, and is replaced
+        generator, args, kwargs = calls[-1]
+        path = cache.path(cache.key(generator, *args, **kwargs))
+        with open(path, "rb") as file:
+            content = file.read()
+        with open(path, "wb") as file:
+            file.write(content[:len(content) // 2])
+        assert cache.load(cache.key(generator, *args, **kwargs)) is None, "truncated entry loaded"
+        _, clumpHit = cache.generate(generator, *args, **kwargs)
+        assert np.array_equal(clumpHit.radii, clump.radii) and os.path.getsize(path) == len(content)
+
+        entries = len(os.listdir(directory))
+        octahedron = os.path.join(GEOMETRIES, "Octahedron_Coarse_Mesh.stl")
+        cache.generate(GenerateClump_Ferellec_McDowell, octahedron, 0.5, 0.1, 0.1, 0.05)
+        assert len(os.listdir(directory)) == entries, "unseeded clump cached"
+
+
+def checkMaximumIndex():
+    """
+    MaximumIndex: after any sequence of decreases, the maximum and its voxels are those of np.max and np.argwhere, and
+    the candidates are all the voxels above the given value (down to the threshold of the index).
+    """
+    rng = np.random.default_rng(2)
+    values = rng.integers(0, 400, size=(12, 13, 14)).astype(np.float32)  # Squared distances are integers
+    index = MaximumIndex(values)
+
+    for step in range(300):
+        maximum, indices = index.maximum()
+        assert maximum == np.max(values), f"step {step}: maximum {maximum} instead of {np.max(values)}"
+        assert np.array_equal(np.unravel_index(indices, values.shape), tuple(np.argwhere(values == maximum).T)), \
+            f"step {step}: voxels of the maximum differ from np.argwhere"
+
+        minimum = max(maximum - 20, index.threshold)
+        candidates, flat = index.candidates(minimum)
+        assert np.array_equal(np.sort(flat), np.flatnonzero(values >= minimum)), f"step {step}: candidates differ"
+        assert np.array_equal(candidates, values.reshape(-1)[flat])
+
+        # Carve a random box around one of the voxels of the maximum, as a sphere does
+        center = np.unravel_index(indices[rng.integers(indices.size)], values.shape)
+        box = tuple(slice(max(c - rng.integers(1, 5), 0), c + rng.integers(1, 5)) for c in center)
+        old = values[box].copy()
+        values[box] = np.minimum(old, rng.integers(0, int(maximum) + 1, size=old.shape) // 2)
+        index.update(box, values[box] < old)
+
+
+def checkBatchPlacement():
+    """
+    GenerateClump_Euclidean_3D: with batchTolerance=0, the batch placement gives the clump of the single-sphere
+    placement. With a tolerance, replaying the clump sphere by sphere on the full distance map shows that each radius is
+    the distance at its centre when it is carved, and within the tolerance of the maximum distance.
+    """
+    i, j, k = np.ogrid[:40, :34, :30]
+    image = ((i - 19.5) / 19) ** 2 + ((j - 16.5) / 13) ** 2 + ((k - 14.5) / 9) ** 2 <= 1
+    tolerance = 0.1
+
+    for overlap in (0.0, 0.4):
+        _, single = GenerateClump_Euclidean_3D(image, 25, 0, 1, overlap, crop=False)
+        _, batch = GenerateClump_Euclidean_3D(image, 25, 0, 1, overlap, crop=False, batchTolerance=0)
+        assert np.array_equal(batch.radii, single.radii) and np.array_equal(batch.positions, single.positions), \
+            f"overlap {overlap}: batchTolerance=0 differs from the single-sphere placement"
+
+        _, clump = GenerateClump_Euclidean_3D(image, 25, 0, 1, overlap, crop=False, batchTolerance=tolerance)
+        replay = np.pad(image, 2)  # Padded and centred as in the generator, with a voxel size of 1
+        halfSize = np.array(replay.shape) / 2
+        for sphere, (position, radius) in enumerate(zip(clump.positions, clump.radii.ravel())):
+            center = np.round(position + halfSize - 1).astype(int)
+            edtImage = squaredEDT(replay)
+            assert np.sqrt(np.float64(edtImage[tuple(center)])) == radius, \
+                f"overlap {overlap}, sphere {sphere}: radius is not the distance at its centre"
+            assert radius >= (1 - tolerance) * np.sqrt(np.float64(np.max(edtImage))), \
+                f"overlap {overlap}, sphere {sphere}: radius outside the tolerance"
+
+            box, inside = sphereBox(replay.shape, center - 1, (1 - overlap) * radius, (1 - overlap) * radius)
+            replay[box] &= ~inside
+
+
+def checkVoxeliser():
+    """
+    Voxeliser: the "scanline" voxelisation gives the grid of trimesh's "subdivide" voxelisation (as padded by
+    GenerateClump_Euclidean_3D) on the cube, hence the same clump, and on a curved surface differs from it only by a
+    few voxels next to the surface.
+    """
+    for geometry, exact in (("Hexahedron_Coarse_Mesh.stl", True), ("Ellipsoid_R_2.0_1.0_0.5.stl", False)):
+        mesh = trimesh.load_mesh(os.path.join(GEOMETRIES, geometry))
+        mesh.vertices -= (np.min(mesh.vertices, axis=0) + np.max(mesh.vertices, axis=0)) / 2  # As in the generator
+        pitch = np.min(np.ptp(mesh.vertices, axis=0)) / 30
+
+        reference = np.pad(np.array(mesh.voxelized(pitch=pitch, method="subdivide").fill().matrix, dtype=bool), 2)
+        image, _ = voxelise(mesh.vertices, mesh.faces, pitch)
+
+        assert image.shape == reference.shape, f"{geometry}: grid of shape {image.shape} instead of {reference.shape}"
+        different = image ^ reference
+        if exact:
+            assert not np.any(different), f"{geometry}: {np.sum(different)} voxels differ from trimesh"
+        else:
+            assert np.sum(different) <= 0.02 * np.sum(reference), f"{geometry}: {np.sum(different)} voxels differ"
+            assert not np.any(different & ~binary_dilation(reference) & ~binary_dilation(image)), \
+                f"{geometry}: voxels differ away from the surface"
+
+    cube = os.path.join(GEOMETRIES, "Hexahedron_Coarse_Mesh.stl")
+    _, subdivide = GenerateClump_Euclidean_3D(cube, 10, 0, 30, 0.5, voxeliser="subdivide")
+    _, scanline = GenerateClump_Euclidean_3D(cube, 10, 0, 30, 0.5, voxeliser="scanline")
+    assert np.array_equal(scanline.positions, subdivide.positions) and \
+        np.array_equal(scanline.radii, subdivide.radii), \
+        "the clumps of the two voxelisers differ on the cube"
+
+
+CHECKS = [checkBatchWorkerCrash, checkBatchBrokenSubmit, checkCrustGrouping, checkCrustMarking, checkSTLFormats,
+          checkContactDetection, checkExactRadius, checkVoxelMesh, checkClumpCache, checkMaximumIndex,
+          checkBatchPlacement, checkVoxeliser]
+
+
+def runChecks(nameFilter=None):
+    """
+    :param nameFilter: If given, only the checks whose name contains this string are run
+    :return: failed: list of the names of the failed checks
+    """
+    failed = []
+    for check in CHECKS:
+        if nameFilter is not None and nameFilter not in check.__name__:
+            continue
+
+        start = time.perf_counter()
+        try:
+            check()
+        except Exception as error:  # an optimised path raising is a failure as well
+            failed.append(check.__name__)
+            print(f"FAIL {check.__name__}: {type(error).__name__}: {error}")
+        else:
+            print(f"ok   {check.__name__} ({time.perf_counter() - start:.2f} s)")
+
+    return failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run the regression checks of the optimised code paths.")
+    parser.add_argument("--filter", default=None, help="Only run the checks whose name contains this string")
+    args = parser.parse_args()
+
+    sys.exit(1 if runChecks(args.filter) else 0)
@@ -0,0 +1,21 @@
+from functions.GenerateClump_Batch import GenerateClump_Batch
+import sys
+sys.path.append('../')
+
+inputGeoms = 'ParticleGeometries'
+generator = 'Euclidean_3D'
+outputDir = 'EU_batch'
+processes = 4
+retries = 1
+N = 10
+rMin = 0
+div = 50
+overlap = 0.5
+
+if __name__ == '__main__':
+    results, failures = GenerateClump_Batch(inputGeoms=inputGeoms, generator=generator, outputDir=outputDir,
+                                            processes=processes, retries=retries, N=N, rMin=rMin, div=div,
+                                            overlap=overlap)
+
+    for inputGeom, error in failures.items():
+        print(f"{inputGeom} failed:\n{error}")
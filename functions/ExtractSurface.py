@@ -1,6 +1,7 @@
 import numpy as np
-from scipy.spatial import ConvexHull
+from scipy.spatial import ConvexHull, cKDTree
 from functions.utils.MyCrust.MyRobustCrust import MyRobustCrust
+from functions.utils.Profiler import stage
 
 import matplotlib.pyplot as plt
 from mpl_toolkits.mplot3d.art3d import Poly3DCollection
@@ -26,6 +27,37 @@ def sphereContact(sphere1, sphere2):
         return False
 
 
+def contactDetection(spheresList):
+    """
+    Find all pairs of intersecting spheres, using a KD-tree of the sphere centres instead of testing all pairs.
+
+    :param spheresList: [N x 4] [x,y,z,r] of each sphere
+    :return: interactions: [M x 2] indices [i,j], i<j, of the intersecting spheres, sorted by i and then by j
+             distances: [M] centroidal distance of the spheres of each interaction
+    """
+    centers = spheresList[:, 0:3]
+    radii = spheresList[:, 3]
+
+    # Two spheres can only intersect if their centres are closer than the sum of their radii, i.e. than twice the larger
+    # radius. Each pair is therefore found by the query of its larger sphere (the first one for equal radii) within
+    # twice its own radius, so that a single large sphere does not widen the search of all the other spheres.
+    tree = cKDTree(centers)
+    neighbours = tree.query_ball_point(centers, 2 * radii)
+    counts = np.fromiter((len(n) for n in neighbours), dtype=np.int64, count=len(neighbours))
+    i = np.repeat(np.arange(len(neighbours)), counts)
+    j = np.fromiter((j for n in neighbours for j in n), dtype=np.int64, count=np.sum(counts))
+    larger = (radii[j] < radii[i]) | ((radii[j] == radii[i]) & (j > i))
+    pairs = np.sort(np.column_stack((i[larger], j[larger])), axis=1)
+    pairs = pairs[np.lexsort((pairs[:, 1], pairs[:, 0]))]
+
+    # Same criterion as sphereContact
+    distances = np.linalg.norm(centers[pairs[:, 1]] - centers[pairs[:, 0]], axis=1)
+    r1, r2 = radii[pairs[:, 0]], radii[pairs[:, 1]]
+    inContact = (r1 + r2 > distances) & (distances > np.abs(r1 - r2))
+
+    return pairs[inContact], distances[inContact]
+
+
 def makeSphere(X, Y, Z, radius, N):
     """
     Function to create a surface mesh of a sphere with radius r, centered at (x,y,z) with N vertices.
@@ -79,12 +111,13 @@ def spherePotential(point, sphere, allowZero):
     return isInside
 
 
-def ExtractSurface(clump, N_sphere, N_circle, visualise):
+def ExtractSurface(clump, N_sphere, N_circle, visualise, profiler=None):
     """
     :param clump: either "clump" object or N x 4 matrix with columns of [x,y,z,r], where x,y,z the centroid of each sphere and r its radius
     :param N_sphere: Number of vertices on the surface of each member-sphere of the clump
     :param N_circle: Number of vertices on the circle defined as the intersection of two overlapping spheres
     :param visualise: Boolean whether to plot the generated surface mesh of the clump surface
+    :param profiler: Optional Profiler, receiving the timing and the element counts of each stage
     :return: faces: faces of generated surface mesh
              vertices : vertices of generated surface mesh
     """
@@ -99,97 +132,110 @@ def ExtractSurface(clump, N_sphere, N_circle, visualise):
     x, y, z, r = zip(*clump)
     spheresList = clump
 
-    # Contact detection between all spheres (all possible combinations) - Record interactions
-    interactions = []
-    for i in range(spheresList.shape[0] - 1):
-        for j in range(i + 1, spheresList.shape[0]):
-            if i == j:
-                continue
-            inContact = sphereContact(spheresList[i, :], spheresList[j, :])
-            if inContact:
-                interactions.append([i, j])
-
-    interactions = np.array(interactions)
+    # Contact detection between all spheres - Record interactions
+    with stage(profiler, "contactDetection", spheres=spheresList.shape[0]) as counts:
+        interactions, distances = contactDetection(spheresList)
+        counts["interactions"] = interactions.shape[0]
 
     # Generate points for each sphere
-    S_struct = []
-    for i in range(spheresList.shape[0]):
-        S_vertices, S_faces = makeSphere(x[i], y[i], z[i], r[i], N_sphere)
-        S_dict = {"vertices": S_vertices, "faces": S_faces}
-        S_struct.append(S_dict)
-
-    # Calculate points on the intersection of each pair of interacting spheres
-    for i in range(interactions.shape[0]):
-        n = spheresList[interactions[i, 1], :3] - spheresList[interactions[i, 0], :3]  # (not normalised) normal vector of each interaction
-        d = np.linalg.norm(n)  # centroidal distance between sphere1-sphere2 in each interaction
-        n = n / np.linalg.norm(n)  # normalised normal vector of each interaction
-
-        r1 = spheresList[interactions[i, 0], 3]  # radius of sphere1
-        r2 = spheresList[interactions[i, 1], 3]  # radius of sphere2
-
-        h = np.sqrt((2 * r1 * d) ** 2 - (r1 ** 2 + d ** 2 - r2 ** 2) ** 2) / (2 * d)  # Radius of intersection circle
-        alph = np.arccos((r1 ** 2 + d ** 2 - r2 ** 2) / (2 * r1 * d))
-        h1 = r1 * (1 - np.cos(alph))
-        C = spheresList[interactions[i, 0], 0:3] + n * (r1 - h1)  # Contact point
-
-        n3 = n
-        n1 = np.array([n[2], 0, -n[0]])  # Vector perpendicular to n
-
-        if np.linalg.norm(n1) == 0:
-            n1 = np.array([n[1], 0, -n[0]])
-
-        n1 = n1 / np.linalg.norm(n1)  # Normalise n1
-        n2 = np.cross(n3, n1)
-
-        # Generate points of intersection circle
-        step = 2 * np.pi / N_circle
-        a = np.arange(-np.pi, np.pi + step, step)
-        px = C[0] + h * (n1[0] * np.cos(a) + n2[0] * np.sin(a))
-        py = C[1] + h * (n1[1] * np.cos(a) + n2[1] * np.sin(a))
-        pz = C[2] + h * (n1[2] * np.cos(a) + n2[2] * np.sin(a))
-
-        circlevertices = np.transpose(np.array([px, py, pz]))
-
-        S_struct[i]["circlevertices"] = circlevertices
-
-        S_struct[interactions[i, 0]]['circlevertices'] = circlevertices
-        S_struct[interactions[i, 0]]['vertices'] = np.vstack(
-            (S_struct[interactions[i, 0]]['vertices'],
-             S_struct[interactions[i, 0]]['circlevertices']))
-
-    # Perform contact detection to detect and delete points of each sphere
-    for i in range(interactions.shape[0]):
-        # For interaction [sphere1, sphere2], check which vertices of sphere1 are inside sphere2
-        for j in range(S_struct[interactions[i, 0]]['vertices'].shape[0] - 1, -1, -1):
-            if spherePotential(S_struct[interactions[i, 0]]['vertices'][j, :], spheresList[interactions[i, 1], :], True):
-                S_struct[interactions[i, 0]]['vertices'] = np.delete(S_struct[interactions[i, 0]]['vertices'], j, axis=0)
-
-        # For interaction [sphere1, sphere2], check which vertices of sphere2 are inside sphere1
-        for j in range(S_struct[interactions[i, 1]]['vertices'].shape[0] - 1, -1, -1):
-            if spherePotential(S_struct[interactions[i, 1]]['vertices'][j, :], spheresList[interactions[i, 0], :], True):
-                S_struct[interactions[i, 1]]['vertices'] = np.delete(S_struct[interactions[i, 1]]['vertices'], j, axis=0)
-
-    # Collect vertices from all spheres in one variable
-    vertices = np.empty((0, 3))
-    for i in range(len(S_struct)):
-        vertices = np.vstack((vertices, S_struct[i]['vertices']))
-    vertices = np.unique(vertices, axis=0).real
-
-    faces, _ = MyRobustCrust(vertices)
+    with stage(profiler, "sphereGeneration", spheres=spheresList.shape[0], N_sphere=N_sphere, N_circle=N_circle):
+        S_struct = []
+        for i in range(spheresList.shape[0]):
+            S_vertices, S_faces = makeSphere(x[i], y[i], z[i], r[i], N_sphere)
+            S_dict = {"vertices": S_vertices, "faces": S_faces}
+            S_struct.append(S_dict)
+
+        # Calculate points on the intersection of each pair of interacting spheres
+        for i in range(interactions.shape[0]):
+            n = spheresList[interactions[i, 1], :3] - spheresList[interactions[i, 0], :3]  # (not normalised) normal vector of each interaction
+            d = distances[i]  # centroidal distance between sphere1-sphere2 in each interaction
+            n = n / d  # normalised normal vector of each interaction
+
+            r1 = spheresList[interactions[i, 0], 3]  # radius of sphere1
+            r2 = spheresList[interactions[i, 1], 3]  # radius of sphere2
+
+            h = np.sqrt((2 * r1 * d) ** 2 - (r1 ** 2 + d ** 2 - r2 ** 2) ** 2) / (2 * d)  # Radius of intersection circle
+            alph = np.arccos((r1 ** 2 + d ** 2 - r2 ** 2) / (2 * r1 * d))
+            h1 = r1 * (1 - np.cos(alph))
+            C = spheresList[interactions[i, 0], 0:3] + n * (r1 - h1)  # Contact point
+
+            n3 = n
+            n1 = np.array([n[2], 0, -n[0]])  # Vector perpendicular to n
+
+            if np.linalg.norm(n1) == 0:
+                n1 = np.array([n[1], 0, -n[0]])
+
+            n1 = n1 / np.linalg.norm(n1)  # Normalise n1
+            n2 = np.cross(n3, n1)
+
+            # Generate points of intersection circle
+            step = 2 * np.pi / N_circle
+            a = np.arange(-np.pi, np.pi + step, step)
+            px = C[0] + h * (n1[0] * np.cos(a) + n2[0] * np.sin(a))
+            py = C[1] + h * (n1[1] * np.cos(a) + n2[1] * np.sin(a))
+            pz = C[2] + h * (n1[2] * np.cos(a) + n2[2] * np.sin(a))
+
+            circlevertices = np.transpose(np.array([px, py, pz]))
+
+            S_struct[i]["circlevertices"] = circlevertices
+
+            S_struct[interactions[i, 0]]['circlevertices'] = circlevertices
+            S_struct[interactions[i, 0]]['vertices'] = np.vstack(
+                (S_struct[interactions[i, 0]]['vertices'],
+                 S_struct[interactions[i, 0]]['circlevertices']))
+
+    with stage(profiler, "culling", spheres=spheresList.shape[0]):
+        # Perform contact detection to detect and delete points of each sphere
+        # For each sphere, the vertices inside any of the spheres it interacts with are found at once (same test as
+        # spherePotential with allowZero=True) and deleted in a single compaction.
+        owners = np.concatenate((interactions[:, 0], interactions[:, 1]))
+        neighbours = np.concatenate((interactions[:, 1], interactions[:, 0]))
+        order = np.argsort(owners, kind='stable')
+        owners, neighbours = owners[order], neighbours[order]
+        bounds = np.searchsorted(owners, np.arange(spheresList.shape[0] + 1))
+
+        for i in np.unique(owners):
+            spheres = spheresList[neighbours[bounds[i]:bounds[i + 1]], :]
+            points = S_struct[i]['vertices']
+
+            chunkSize = max(1, 2 ** 22 // points.shape[0])  # neighbours processed at once, to bound the temporaries
+            inside = np.zeros(points.shape[0], dtype=bool)
+            for start in range(0, spheres.shape[0], chunkSize):
+                sphere = spheres[start:start + chunkSize]
+
+                isInside = np.sqrt(((sphere[np.newaxis, :, 0] - points[:, np.newaxis, 0]) ** 2
+                                    + (sphere[np.newaxis, :, 1] - points[:, np.newaxis, 1]) ** 2
+                                    + (sphere[np.newaxis, :, 2] - points[:, np.newaxis, 2]) ** 2)
+                                   / (sphere[np.newaxis, :, 3] ** 2)) - 1 <= 0
+                inside |= np.any(isInside, axis=1)
+
+            S_struct[i]['vertices'] = points[~inside]
+
+    with stage(profiler, "crust") as counts:
+        # Collect vertices from all spheres in one variable
+        vertices = np.empty((0, 3))
+        for i in range(len(S_struct)):
+            vertices = np.vstack((vertices, S_struct[i]['vertices']))
+        vertices = np.unique(vertices, axis=0).real
+
+        counts["vertices"] = vertices.shape[0]
+        faces, _ = MyRobustCrust(vertices, profiler)
+        counts["faces"] = faces.shape[0]
 
     if visualise:
-        fig = plt.figure()
-        ax = fig.add_subplot(111, projection='3d')
+        with stage(profiler, "visualise"):
+            fig = plt.figure()
+            ax = fig.add_subplot(111, projection='3d')
 
-        # Create a Poly3DCollection object
-        polys = Poly3DCollection(vertices[faces], facecolors='cyan', edgecolors='k', alpha=0.70)
-        ax.add_collection3d(polys)
+            # Create a Poly3DCollection object
+            polys = Poly3DCollection(vertices[faces], facecolors='cyan', edgecolors='k', alpha=0.70)
+            ax.add_collection3d(polys)
 
-        # Auto-scale to the mesh size
-        scale = vertices.flatten('F')
-        ax.auto_scale_xyz(scale, scale, scale)
+            # Auto-scale to the mesh size
+            scale = vertices.flatten('F')
+            ax.auto_scale_xyz(scale, scale, scale)
 
-        # Show the plot
-        plt.show()
+            # Show the plot
+            plt.show()
 
     return faces, vertices
@@ -0,0 +1,167 @@
+import os
+import traceback
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from functions.GenerateClump_Euclidean_3D import GenerateClump_Euclidean_3D
+from functions.GenerateClump_Favier import GenerateClump_Favier
+from functions.GenerateClump_Ferellec_McDowell import GenerateClump_Ferellec_McDowell
+
+"""
+Batch clump generation for a library of particle geometries
+
+The main concept of this functionality:
+1. We collect a list of particle geometries, either given explicitly or as all the .stl/.mat files of a directory.
+2. The same clump generator and parameter set is applied to every particle, distributing the particles over a pool
+   of processes.
+3. A particle that fails is retried a given number of times and, if it still fails, it is reported together with
+   its traceback, without interrupting the generation of the rest of the batch. If a worker process dies abruptly
+   (e.g. killed for running out of memory), a fresh pool is started and the unfinished particles are resubmitted;
+   an attempt is only counted against the particle which was running in the dead worker.
+4. The results are returned in the order of the input geometries and, optionally, the clump of each particle is
+   written to a .txt file in an output directory.
+"""
+
+GENERATORS = {"Euclidean_3D": GenerateClump_Euclidean_3D,
+              "Favier": GenerateClump_Favier,
+              "Ferellec_McDowell": GenerateClump_Ferellec_McDowell}
+
+
+def collectGeometries(inputGeoms):
+    """
+    :param inputGeoms: Directory containing .stl/.mat files, or list of paths of .stl/.mat files
+    :return: list of paths of the particle geometries, sorted by file name if a directory is given
+    """
+    if isinstance(inputGeoms, str):
+        if not os.path.isdir(inputGeoms):
+            raise ValueError("inputGeoms must be a directory or a list of geometry files.")
+        return [os.path.join(inputGeoms, f) for f in sorted(os.listdir(inputGeoms)) if f.endswith((".stl", ".mat"))]
+
+    return list(inputGeoms)
+
+
+def generateOne(generator, inputGeom, retries, kwargs):
+    """
+    Run one clump generator on one particle, catching any error so that the rest of the batch is unaffected.
+
+    :return: result: (mesh, clump) as returned by the generator, or None if all the attempts failed
+             error: traceback of the last failed attempt, or None if the generation succeeded
+    """
+    error = None
+    for _ in range(retries + 1):
+        try:
+            return generator(inputGeom, **kwargs), None
+        except Exception:
+            error = traceback.format_exc()
+
+    return None, error
+
+
+def GenerateClump_Batch(inputGeoms, generator, outputDir=None, processes=None, retries=0, **kwargs):
+    """
+    :param inputGeoms: Directory containing .stl/.mat files, or list of paths of .stl/.mat files
+    :param generator: Clump generator to use: one of "Euclidean_3D", "Favier", "Ferellec_McDowell", or the
+                      GenerateClump_* function itself
+    :param outputDir: Directory where the clump of each particle is written as <particle name>.txt, with format
+                      [x,y,z,r]. If not assigned, no output files are created.
+    :param processes: Number of worker processes. If None, the number of CPUs is used. If 1, the particles are
+                      generated sequentially in the calling process.
+    :param retries: Number of additional attempts for a particle whose generation fails, or whose worker process dies
+    :param kwargs: Parameter set passed to the generator for every particle, e.g. N=10, rMin=0, div=50, overlap=0.5
+                   for GenerateClump_Euclidean_3D. The optional variables "output", "visualise" and "VTK" are
+                   ignored, as the output files are controlled by outputDir.
+    :return: results: list with the (mesh, clump) result of each particle, in the order of the input geometries.
+                      The entry of a particle that failed is None.
+             failures: dictionary mapping the path of each particle that failed to the traceback of its last attempt
+    """
+    if isinstance(generator, str):
+        try:
+            generator = GENERATORS[generator]
+        except KeyError:
+            raise ValueError(f"Not recognised generator. Use one of {list(GENERATORS)}.")
+
+    inputGeoms = collectGeometries(inputGeoms)
+
+    for key in ("output", "visualise", "VTK"):
+        kwargs.pop(key, None)
+
+    if outputDir is not None:
+        os.makedirs(outputDir, exist_ok=True)
+
+    particleKwargs = []
+    for inputGeom in inputGeoms:
+        pKwargs = dict(kwargs)
+        if outputDir is not None:
+            name = os.path.splitext(os.path.basename(inputGeom))[0]
+            pKwargs["output"] = os.path.join(outputDir, name + ".txt")
+        particleKwargs.append(pKwargs)
+
+    results = [None] * len(inputGeoms)
+    failures = {}
+
+    if processes == 1:
+        for i, inputGeom in enumerate(inputGeoms):
+            results[i], error = generateOne(generator, inputGeom, retries, particleKwargs[i])
+            if error is not None:
+                failures[inputGeom] = error
+        return results, failures
+
+    # Attempts of each particle lost to a dead worker. The particles in flight when a worker died are suspects: they
+    # are rerun one at a time, so that the attempt is only counted against the particle which kills its worker.
+    attempts = [0] * len(inputGeoms)
+    queue = deque(range(len(inputGeoms)))
+    suspects = deque()
+
+    while queue or suspects:
+        isolated = bool(suspects)
+        source = suspects if isolated else queue
+        numWorkers = 1 if isolated else (processes or os.cpu_count() or 1)
+
+        inFlight = {}
+        crash = None
+        with ProcessPoolExecutor(max_workers=numWorkers) as executor:
+            while (source or inFlight) and crash is None:
+                # Only as many particles as workers are submitted, so that the suspects of a crash are known
+                while source and len(inFlight) < numWorkers:
+                    i = source.popleft()
+                    try:
+                        future = executor.submit(generateOne, generator, inputGeoms[i], retries - attempts[i],
+                                                 particleKwargs[i])
+                    except BrokenProcessPool:  # A worker died since the last wait
+                        crash = traceback.format_exc()
+                        source.appendleft(i)
+                        break
+                    inFlight[future] = i
+
+                if crash is not None:
+                    break
+
+                done, _ = wait(inFlight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        results[inFlight[future]], error = future.result()
+                    except BrokenProcessPool:
+                        crash = traceback.format_exc()
+                        continue
+                    i = inFlight.pop(future)
+                    if error is not None:
+                        failures[inputGeoms[i]] = error
+
+        if crash is None:
+            continue
+
+        crashed = list(inFlight.values())
+        if not crashed:  # The pool broke with no particle in flight: the attempt is counted against the next one
+            crashed = [source.popleft()]
+
+        if len(crashed) > 1:
+            suspects.extend(crashed)
+        else:
+            i = crashed[0]
+            attempts[i] += 1
+            if attempts[i] > retries:
+                failures[inputGeoms[i]] = crash
+            else:
+                source.appendleft(i)
+
+    return results, failures
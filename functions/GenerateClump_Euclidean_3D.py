@@ -2,9 +2,13 @@ import numpy as np
 import trimesh
 from scipy.ndimage import distance_transform_edt
 from functions.utils.ClumpPlotter import clump_plotter_pyvista
-from scipy.io import loadmat
 from functions.utils import RigidBodyParameters
+from functions.utils import VoxelReader
+from functions.utils import Voxeliser
 from functions.utils.VTK_writer import clump_to_VTK
+from functions.utils.Clump import Clump
+from functions.utils.Profiler import stage
+from functions.utils.MaximumIndex import MaximumIndex
 
 """
 Clump generator using the Euclidean map for voxelated, 3D particles 
@@ -24,27 +28,357 @@ The main concept of this methodology:
 5. This process is repeated until a user-defined number of spheres 'N' is
    found or until the user-defined minimum radius criterion has been met,
    as the spheres are generated in decreasing sizes.
+
+Memory: the Euclidean map is stored as float32 squared distances (4 bytes per voxel of the padded image) and, when it
+is needed after the first transform, the binary image is bit-packed (1 bit per voxel). The peak of the main body is
+reached while computing a full transform (see squaredEDT): about 22 bytes per voxel, i.e. the binary image, scipy's
+int32 feature transform and its int8/int64 copies of the input. Between the transforms, about 4 bytes per voxel are
+held, plus the index of the largest distances used to select the centres (see MaximumIndex), i.e. 4 bytes per voxel
+at least half as far from the surface as the centre of the largest remaining sphere. With coarseFactor, the full
+transforms are computed on the coarse image, so the peak is about 2 bytes per fine voxel plus 22 bytes per coarse
+voxel. The "scanline" voxelisation of .stl files (see functions.utils.Voxeliser) holds about 3 bytes per voxel of the
+padded image; the "subdivide" one (trimesh) is not bounded per voxel, as it subdivides the mesh.
 """
 
 
-class Clump:
-    def __init__(self):
-        self.positions = np.empty((0, 3))
-        self.radii = np.empty((0, 1))
-        self.minRadius = None
-        self.maxRadius = None
-        self.numSpheres = None
+def sphereBox(shape, center, radius, extent):
+    """
+    Find the voxels of a sphere inside an axis-aligned sub-box of a voxel image, without building full-size grids.
+
+    :param shape: Shape of the voxel image
+    :param center: [1 x 3] voxel indices of the centre of the sphere
+    :param radius: Radius of the sphere, in voxels
+    :param extent: Half-width of the sub-box around the centre, in voxels (at least the radius)
+    :return: box: tuple of slices of the sub-box, clipped to the image
+             inside: boolean array with the shape of the sub-box, True for the voxels of the sphere
+    """
+    extent = int(np.ceil(extent)) + 1
+    lo = np.maximum(np.floor(center).astype(int) - extent, 0)
+    hi = np.minimum(np.ceil(center).astype(int) + extent + 1, shape)
+    box = tuple(slice(start, stop) for start, stop in zip(lo, hi))
+
+    i, j, k = np.ogrid[box]
+    inside = np.sqrt((i - center[0]) ** 2 + (j - center[1]) ** 2 + (k - center[2]) ** 2) <= radius
+
+    return box, inside
+
+
+def squaredEDT(image):
+    """
+    Squared Euclidean distance map of a boolean image, stored in float32.
+
+    Only the feature transform of scipy (3 int32 per voxel) is kept at full size; the distances are computed from it
+    slab by slab, instead of through the float64 temporaries of distance_transform_edt (about 50 bytes per voxel).
+    Squared distances are integers, so they are exact in float32 as long as they are below 2 ** 24 (distances below
+    4096 voxels), and np.sqrt(np.float64(d2)) is identical to the distance computed by distance_transform_edt.
+
+    :param image: Boolean voxel image, True inside the particle
+    :return: edtImage: float32 squared Euclidean distance of each voxel to the nearest voxel outside the particle
+    """
+    ft = np.empty((image.ndim,) + image.shape, dtype=np.int32)
+    distance_transform_edt(image, return_distances=False, return_indices=True, indices=ft)
+
+    edtImage = np.empty(image.shape, dtype=np.float32)
+    step = max(1, 2 ** 20 // max(1, int(np.prod(image.shape[1:]))))
+    for start in range(0, image.shape[0], step):
+        slab = slice(start, min(start + step, image.shape[0]))
+        grid = np.ogrid[(slab,) + tuple(slice(0, n) for n in image.shape[1:])]
+
+        d2 = np.zeros(edtImage[slab].shape, dtype=np.float32)
+        for axis in range(image.ndim):
+            diff = (ft[axis, slab] - grid[axis]).astype(np.float32)
+            d2 += diff * diff
+        edtImage[slab] = d2
+
+    return edtImage
+
+
+def packOccupancy(image):
+    """
+    :param image: Boolean voxel image
+    :return: packed: image packed to 1 bit per voxel along its last axis
+    """
+    return np.packbits(image, axis=-1)
+
+
+def unpackOccupancy(packed, box):
+    """
+    :param packed: Voxel image packed with packOccupancy
+    :param box: tuple of slices (with explicit bounds) of the region to unpack
+    :return: region: Boolean voxel image of the region
+    """
+    k = box[-1]
+    first = k.start // 8
+
+    bits = np.unpackbits(packed[box[:-1] + (slice(first, -(-k.stop // 8)),)], axis=-1)
+
+    return bits[..., k.start - 8 * first:k.stop - 8 * first].view(bool)
+
+
+def carveOccupancy(packed, box, inside):
+    """
+    Set the voxels of a region of a packed voxel image to False.
+
+    :param packed: Voxel image packed with packOccupancy. It is updated in place.
+    :param box: tuple of slices (with explicit bounds) of the region
+    :param inside: Boolean array with the shape of the region, True for the voxels to set to False
+    """
+    k = box[-1]
+    first = k.start // 8
+    region = box[:-1] + (slice(first, -(-k.stop // 8)),)
+
+    bits = np.unpackbits(packed[region], axis=-1)
+    bits[..., k.start - 8 * first:k.stop - 8 * first] &= ~inside
+    packed[region] = np.packbits(bits, axis=-1)
+
+
+def updateEDT(edtImage, center, radius, reach, index=None):
+    """
+    Update a Euclidean distance map after a sphere of voxels has been set to zero.
+
+    Carving only decreases distances, and a voxel can only get closer to the carved sphere than to its previous
+    nearest background voxel if it lies within "reach" (carving radius + largest distance in the map) of the sphere
+    centre. Hence, the distances to the carved voxels are computed in the bounding box of that region only, and
+    merged with the existing map. The result is identical to recomputing the transform over the whole volume.
+
+    :param edtImage: Squared Euclidean distance map of the image before carving (see squaredEDT). It is updated in
+                     place.
+    :param center: [1 x 3] voxel indices of the centre of the carved sphere
+    :param radius: Radius of the carved sphere, in voxels
+    :param reach: Carving radius plus the maximum distance of edtImage, in voxels
+    :param index: Optional MaximumIndex of edtImage, to which the decreased distances are reported
+    :return: edtImage: Squared Euclidean distance map of the image after carving
+    """
+    box, inside = sphereBox(edtImage.shape, center, radius, reach)
+
+    localEdt = squaredEDT(~inside)
+    changed = localEdt < edtImage[box]
+    np.minimum(edtImage[box], localEdt, out=edtImage[box])
+
+    if index is not None:
+        index.update(box, changed)
+
+    return edtImage
+
+
+def coarsenOccupancy(image, factor):
+    """
+    Downsample a voxel image by an integer factor. A coarse voxel belongs to the particle only if all its fine voxels
+    do, so the coarse particle is contained in the fine one.
+
+    :param image: Boolean voxel image, with a shape divisible by factor
+    :param factor: Number of fine voxels along each edge of a coarse voxel
+    :return: coarse: Boolean coarse voxel image
+    """
+    nx, ny, nz = image.shape
+
+    return image.reshape(nx // factor, factor, ny // factor, factor, nz // factor, factor).all(axis=(1, 3, 5))
+
+
+def refineCenter(occupancy, shape, coarseRadius2, candidates, factor, centroid):
+    """
+    Locate the largest inscribed sphere on the fine voxel image, around the maxima of the coarse distance map.
+
+    The fine distance map is computed only in a window around the coarse voxels of maximum distance, wide enough to
+    contain the nearest background voxel of each of their fine voxels, and its maximum over these fine voxels is
+    taken, with ties broken as in the single-resolution algorithm. If a fine voxel lies in coarse voxel P, its fine
+    distance differs from factor * (coarse distance of P) by at most sqrt(3) * (factor - 1), which bounds the
+    maximum of the whole fine distance map from above.
+
+    :param occupancy: Fine voxel image, True inside the particle, packed with packOccupancy
+    :param shape: Shape of the fine voxel image
+    :param coarseRadius2: Maximum of the squared Euclidean distance map of the coarse image, in coarse voxels
+    :param candidates: [M x 3] indices of the coarse voxels where the coarse map attains coarseRadius2
+    :param factor: Number of fine voxels along each edge of a coarse voxel
+    :param centroid: Point used to break ties, as in the single-resolution algorithm
+    :return: center: [1 x 3] fine voxel indices of the centre of the sphere
+             radius: Fine Euclidean distance of the centre, in fine voxels
+             tolerance: Upper bound of the difference between the maximum of the fine distance map and radius
+    """
+    upper = factor * np.sqrt(np.float64(coarseRadius2)) + np.sqrt(3) * (factor - 1)
+
+    extent = int(np.ceil(upper)) + 1
+    lo = np.maximum(np.min(candidates, axis=0) * factor - extent, 0)
+    hi = np.minimum((np.max(candidates, axis=0) + 1) * factor + extent, shape)
+
+    windowEdt = squaredEDT(unpackOccupancy(occupancy, tuple(slice(start, stop) for start, stop in zip(lo, hi))))
+
+    # Fine voxels of the candidate coarse voxels, relative to the window
+    offsets = np.indices((factor, factor, factor)).reshape(3, -1).T
+    points = (candidates[:, np.newaxis, :] * factor + offsets).reshape(-1, 3) - lo
+    distances = windowEdt[points[:, 0], points[:, 1], points[:, 2]]
+
+    radius2 = np.max(distances)
+    xyzCenter = points[distances == radius2] + lo
+
+    dists = np.sqrt(np.sum(np.power(centroid - xyzCenter, 2), axis=1))
+    i = np.argmax(dists)
+
+    radius = np.sqrt(np.float64(radius2))
+
+    return xyzCenter[i], radius, upper - radius
+
+
+def updateCoarseEDT(coarseEdt, coarse, occupancy, box, factor, reach, index=None):
+    """
+    Update the coarse image and its Euclidean distance map after the fine voxels of box have been carved.
+
+    :param coarseEdt: Squared Euclidean distance map of the coarse image (see squaredEDT). It is updated in place.
+    :param coarse: Boolean coarse voxel image. It is updated in place.
+    :param occupancy: Fine voxel image after carving, packed with packOccupancy
+    :param box: tuple of slices of the carved fine voxels
+    :param factor: Number of fine voxels along each edge of a coarse voxel
+    :param reach: Maximum distance of coarseEdt before carving, in coarse voxels
+    :param index: Optional MaximumIndex of coarseEdt, to which the decreased distances are reported
+    :return: coarseEdt: Squared Euclidean distance map of the coarse image after carving
+    """
+    cbox = tuple(slice(b.start // factor, -(-b.stop // factor)) for b in box)
+    pooled = coarsenOccupancy(unpackOccupancy(occupancy, tuple(slice(c.start * factor, c.stop * factor) for c in cbox)),
+                              factor)
+
+    newZeros = coarse[cbox] & ~pooled
+    coarse[cbox] = pooled
+    if not np.any(newZeros):
+        return coarseEdt
+
+    # Only the distances smaller than the current ones change, i.e. within reach of the new background voxels
+    extent = int(np.ceil(reach)) + 1
+    lo = [max(c.start - extent, 0) for c in cbox]
+    hi = [min(c.stop + extent, n) for c, n in zip(cbox, coarse.shape)]
+    window = tuple(slice(start, stop) for start, stop in zip(lo, hi))
+
+    zeros = np.zeros([stop - start for start, stop in zip(lo, hi)], dtype=bool)
+    zeros[tuple(slice(c.start - start, c.stop - start) for c, start in zip(cbox, lo))] = newZeros
+
+    localEdt = squaredEDT(~zeros)
+    changed = localEdt < coarseEdt[window]
+    np.minimum(coarseEdt[window], localEdt, out=coarseEdt[window])
+
+    if index is not None:
+        index.update(window, changed)
+
+    return coarseEdt
+
+
+def selectBatch(index, centroid, overlap, tolerance, maxSpheres):
+    """
+    Select several spheres from the same distance map, which do not interact when they are carved one after the other.
+
+    The candidates are the voxels whose distance is within the relative tolerance of the maximum, taken in the order
+    of the single-sphere algorithm (decreasing distance, then decreasing distance from centroid). A candidate is kept
+    only if the carving of every sphere accepted before it cannot decrease its distance, i.e. if it is farther from
+    the carved sphere than from its nearest background voxel. Hence, the radius of each sphere is its exact distance
+    at the time it is carved, and it is at least (1 - tolerance) times the radius the single-sphere algorithm would
+    select at the same step, since the maximum of the map never increases.
+
+    :param index: MaximumIndex of the squared Euclidean distance map
+    :param centroid: Point used to break ties, as in the single-sphere algorithm
+    :param overlap: Overlap percentage of the spheres, as in GenerateClump_Euclidean_3D
+    :param tolerance: Relative tolerance of the radii with respect to the maximum distance of the map
+    :param maxSpheres: Maximum number of spheres to select
+    :return: batch: list of (center, radius) of the selected spheres, with center the [1 x 3] voxel indices and
+                    radius in voxels, in decreasing radius
+    """
+    maximum, _ = index.maximum()
+    values, indices = index.candidates(maximum * (1 - tolerance) ** 2)
+
+    points = np.column_stack(np.unravel_index(indices, index.values.shape))
+    dists = np.sqrt(np.sum(np.power(centroid - points, 2), axis=1))
+    order = np.lexsort((indices, -dists, -values))
+    points, radii = points[order], np.sqrt(values[order].astype(np.float64))
+
+    batch = []
+    while radii.size and len(batch) < maxSpheres:
+        center, radius = points[0], radii[0]
+        batch.append((center, radius))
+
+        # The carved sphere is centred one voxel below center (see GenerateClump_Euclidean_3D)
+        points, radii = points[1:], radii[1:]
+        free = np.sqrt(np.sum(np.power(points - (center - 1), 2), axis=1)) - (1 - overlap) * radius >= radii
+        points, radii = points[free], radii[free]
+
+    return batch
+
+
+def readVoxelImage(inputGeom, options, profiler=None):
+    """
+    Read a voxelated image directly into the padded binary image used by the main loop, without meshing it.
+
+    :param inputGeom: Directory of a .mat, .npy or raw binary voxelated image, or [Nx x Ny x Nz] array
+    :param options: Optional variables of GenerateClump_Euclidean_3D ("voxelSize", "crop", "threshold", "key",
+                    "rawShape", "rawDtype", "rawOffset", "rawOrder")
+    :param profiler: Optional Profiler
+    :return: mesh: rigid body parameters of the voxelated particle (VoxelRBP)
+             intersection: padded boolean image, True inside the particle
+             voxel_size: voxel size
+    """
+    with stage(profiler, "load") as counts:
+        img, voxel_size, _ = VoxelReader.read_voxels(inputGeom, voxel_size=options.get('voxelSize'),
+                                                     crop=options.get('crop', True),
+                                                     threshold=options.get('threshold', 0), key=options.get('key'),
+                                                     shape=options.get('rawShape'),
+                                                     dtype=options.get('rawDtype', np.uint8),
+                                                     offset=options.get('rawOffset', 0),
+                                                     order=options.get('rawOrder', 'C'))
+        counts["shape"] = img.shape
+
+    intersection = np.pad(img, ((2, 2), (2, 2), (2, 2)), mode='constant')  # pad the array with 2 voxels
+    del img
+
+    # The voxels are placed in the same frame as the generated spheres, i.e. centred on the padded image
+    with stage(profiler, "RBP"):
+        mesh = RigidBodyParameters.VoxelRBP(intersection, voxel_size, origin=1 - np.array(intersection.shape) / 2)
+
+    return mesh, intersection, voxel_size
 
 
 def GenerateClump_Euclidean_3D(inputGeom, N, rMin, div, overlap, **kwargs):
     """
-    :param inputGeom: Directory of stl file, used to generate spheres
+    :param inputGeom: Input geometry, given in one of the formats below:
+                    1. Directory of .stl file (for surface meshes)
+                    2. Directory of .mat, .npy or raw binary file (for binary voxelated images). A .mat file can
+                       contain the image or a struct with fields {img,voxel_size}.
+                    3. [Nx x Ny x Nz] array (for binary voxelated images)
+                    Voxelated images are used directly as the binary image of the main loop (div is then unused).
     :param N: Number of spheres to be generated.
     :param rMin: Minimum allowed radius: When this radius is met, the generation procedure stops even before N spheres are generated.
     :param div: Division number along the shortest edge of the AABB during voxelisation (resolution). If not given, div=50 (default value in iso2mesh).
     :param overlap: Overlap percentage: [0,1): 0 for non-overlapping spheres, 0.4 for 40% overlap of radii, etc.
-    :param kwargs: Can contain either of the optional variables "output".
+    :param kwargs: Can contain either of the optional variables "output", "incrementalEDT", "coarseFactor",
+                   "batchTolerance", "voxeliser", "workers", "profiler".
                 - File name for output of the clump in .txt form. If not assigned, a .txt output file is not created.
+                - incrementalEDT: If True (default), after each sphere is carved the Euclidean distance map is only
+                recomputed inside the region the new sphere can affect, instead of over the whole voxel volume.
+                The resulting map, and hence the clump, is identical to a full recomputation.
+                - coarseFactor: If given, the multi-resolution mode is used: the distance map is computed on a coarse
+                image with coarseFactor fine voxels along each edge of a coarse voxel, and the centre and radius of
+                each sphere are refined on the fine image (of resolution div) around the coarse maxima only, so the
+                full fine distance map is never computed. The radius of each sphere is a fine distance and differs
+                from the maximum of the fine distance map by at most 2*sqrt(3)*(coarseFactor-1) fine voxels; the
+                bound of each sphere is reported as "radiusTolerance" to the profiler. coarseFactor=2 is usually
+                the fastest.
+                - batchTolerance: If given, several spheres are placed per update of the distance map: the voxels whose
+                distance is within this relative tolerance of the maximum are taken in decreasing distance, and each
+                one is kept if the spheres accepted before it cannot change its distance (see selectBatch). Each
+                radius is then at least (1 - batchTolerance) times the radius the one-at-a-time algorithm would place
+                at the same step; batchTolerance=0 only batches equal maxima. With incrementalEDT=False, one full
+                transform is computed per batch instead of per sphere. It cannot be combined with coarseFactor.
+                - voxeliser: Voxelisation of .stl files. "subdivide" (default) uses trimesh's voxelisation, which
+                marks the voxels of the vertices of the mesh subdivided to half the voxel size and fills the interior;
+                its time and memory grow quickly with div and the size of the mesh. "scanline" voxelises the mesh
+                slice by slice (see functions.utils.Voxeliser), much faster and in bounded memory: a voxel belongs to
+                the particle if its centre is inside the surface or if it contains a point of the surface. Both mark
+                the same voxels on meshes aligned with the voxel grid, but on curved surfaces "scanline" marks a few
+                surface voxels that trimesh's sampling misses, so the clumps can differ slightly.
+                - workers: Number of threads of the "scanline" voxeliser. If not given, the number of CPUs is used.
+                - Options for voxelated images: "voxelSize" (if not stored in the file, default 1), "crop" (if True,
+                default, the image is cropped to the bounding box of the particle), "threshold" (voxels greater than
+                it belong to the particle, default 0), "key" (variable of a .mat file), and "rawShape", "rawDtype"
+                (default uint8), "rawOffset" (header size in bytes, default 0) and "rawOrder" (default 'C') for
+                raw volumes, which are memory-mapped like .npy files. Positions are relative to the centre of the
+                (cropped) image.
+                - profiler: Profiler (see functions.utils.Profiler), receiving the timing and the element counts of
+                each stage. If not assigned, nothing is measured.
     :return: mesh: structure containing all relevant parameters of polyhedron
                     mesh.vertices
                     mesh.faces
@@ -64,9 +398,13 @@ def GenerateClump_Euclidean_3D(inputGeom, N, rMin, div, overlap, **kwargs):
             output: txt file with centroids and radii, with format: [x,y,z,r]
     """
 
+    profiler = kwargs.get('profiler')
+
     if isinstance(inputGeom, str):
         if inputGeom.endswith(".stl"):
-            mesh = trimesh.load_mesh(inputGeom)  # this will be used for voxalization
+            with stage(profiler, "load") as counts:
+                mesh = trimesh.load_mesh(inputGeom)  # this will be used for voxalization
+                counts.update(vertices=mesh.vertices.shape[0], faces=mesh.faces.shape[0])
             F = mesh.faces
             P = mesh.vertices
 
@@ -85,44 +423,28 @@ def GenerateClump_Euclidean_3D(inputGeom, N, rMin, div, overlap, **kwargs):
                 (np.abs(maxX - minX), np.abs(maxY - minY), np.abs(maxZ - minZ)))  # find the shortest length of axes
             voxel_size = min_AABB / div  # determine the voxel size
 
-            img_temp = mesh.voxelized(pitch=voxel_size, method="subdivide").fill()  # voxalize
-
-            intersection = np.pad(np.array(img_temp.matrix), ((2, 2), (2, 2), (2, 2)), mode='constant')  # pad the array with 2 voxels
+            voxeliser = kwargs.get('voxeliser', 'subdivide')
+            with stage(profiler, "voxelise", div=div, voxeliser=voxeliser) as counts:
+                if voxeliser == 'scanline':
+                    # Voxelised slice by slice, directly into the image padded with 2 voxels
+                    intersection, _ = Voxeliser.voxelise(mesh.vertices, mesh.faces, voxel_size, pad=2,
+                                                         workers=kwargs.get('workers'))
+                elif voxeliser == 'subdivide':
+                    img_temp = mesh.voxelized(pitch=voxel_size, method="subdivide").fill()  # voxalize
+
+                    intersection = np.pad(np.array(img_temp.matrix, dtype=bool), ((2, 2), (2, 2), (2, 2)), mode='constant')  # pad the array with 2 voxels
+                    del img_temp
+                else:
+                    raise ValueError("Not recognised voxeliser.")
+                counts["shape"] = intersection.shape
 
             # I skipped the part "Ensure the voxel size is the same in all 3 directions -> Might be an overkill, but still".
             # Maybe add it later - Utku
 
-        elif inputGeom.endswith(".mat"):
-
-            # Load the .mat file
-            data = loadmat(inputGeom)
-            vox_keys = list(data.keys())
-
-            # MATLAB's load function sometimes loads additional meta information starting with '__'
-            # So, let's filter out such keys
-            vox_keys = [key for key in vox_keys if not key.startswith('__')]
-
-            vox = data[vox_keys[0]]
-
-            img = vox['img'][0][0]
-            voxel_size = vox['voxel_size'][0][0]
-
-            opt = 2  # see vol2mesh function in iso2mesh
-            isovalues = []  # see vol2mesh function in iso2mesh
-
-            # Convert voxel data to a mesh using trimesh
-            vox_mesh = trimesh.voxel.Voxel(img).as_mesh()
-            P = vox_mesh.vertices
-            F = vox_mesh.faces
-
-            P = P * voxel_size[0][0]
-
-            # Create a structure equivalent in Python
-            FV = {'vertices': P, 'faces': F}
-
-            RBP, _ = RigidBodyParameters.RBP(FV)
-        else:
-            raise ValueError("Not recognised inputGeom format.")
+        else:  # Voxelated image (.mat, .npy or raw binary volume)
+            mesh, intersection, voxel_size = readVoxelImage(inputGeom, kwargs, profiler)
+    elif isinstance(inputGeom, np.ndarray):  # Voxelated image
+        mesh, intersection, voxel_size = readVoxelImage(inputGeom, kwargs, profiler)
     elif isinstance(type(inputGeom), type):  # check if it is a class ("struct").
         try:
             P = inputGeom.Vertices
@@ -147,47 +469,111 @@ def GenerateClump_Euclidean_3D(inputGeom, N, rMin, div, overlap, **kwargs):
 
     # Dimensions of the new image
     halfSize = np.array(intersection.shape) / 2
-    dx, dy, dz = np.meshgrid(np.arange(1, intersection.shape[1] + 1), np.arange(1, intersection.shape[0] + 1),
-                             np.arange(1, intersection.shape[2] + 1))  # be careful about the order
 
     # Calculate centroid of the voxelated image
     centroid = mesh.centroid  # centroid of the initial particle
 
-    for k in range(N):
-        edtImage = distance_transform_edt(intersection, return_distances=True)
-        radius = np.max(edtImage)
-
-        if radius < rMin:
-            print(f"The mimimum radius rMin={rMin} has been met using {k - 1} spheres")
-
-        xyzCenter = np.argwhere(edtImage == radius)
-
-        dists = np.sqrt(np.sum(np.power(centroid - xyzCenter, 2), axis=1))
-        i = np.argmax(dists)
-
-        sph = np.sqrt(
-            (dx - xyzCenter[i, 1]) ** 2 + (dy - xyzCenter[i, 0]) ** 2 + (dz - xyzCenter[i, 2]) ** 2) > (
-                      1 - overlap) * radius
+    incrementalEDT = kwargs.get('incrementalEDT', True)
+    coarseFactor = kwargs.get('coarseFactor')
+    batchTolerance = kwargs.get('batchTolerance')
+    if batchTolerance is not None and coarseFactor is not None:
+        raise ValueError("batchTolerance and coarseFactor cannot be used together.")
 
-        intersection = np.logical_and(intersection, sph)
-
-        xyzC = xyzCenter[i] - halfSize + 1
-
-        clump.positions = np.vstack((clump.positions, xyzC * voxel_size))
-        clump.radii = np.vstack((clump.radii, radius * voxel_size))
-
-    clump.minRadius = np.min(clump.radii)
-    clump.maxRadius = np.max(clump.radii)
-    clump.numSpheres = len(clump.radii)
-
-    output = kwargs.get('output')
-    if output is not None:
-        np.savetxt(output, np.asarray(np.hstack((clump.positions, clump.radii))),
-                   delimiter=",")  # In PyCharm this line seems to have an error but it does not. Known issue.
-
-    VTK = kwargs.get('VTK')
-    if VTK is not None:
-        clump_to_VTK(clump, filepath=output)
+    with stage(profiler, "edt", voxels=intersection.size):
+        if coarseFactor is None:
+            edtImage = squaredEDT(intersection)
+        else:
+            # Pad the image to a whole number of coarse voxels. Appending background voxels keeps the indices.
+            intersection = np.pad(intersection, [(0, -n % coarseFactor) for n in intersection.shape], mode='constant')
+            coarse = coarsenOccupancy(intersection, coarseFactor)
+            edtImage = squaredEDT(coarse)
+
+        # From now on, the image is only needed to carve the spheres and recompute the distance map, so it is kept
+        # bit-packed. The incremental update of the full-resolution map never reads it, so it is then dropped.
+        shape = intersection.shape
+        occupancy = None if coarseFactor is None and incrementalEDT else packOccupancy(intersection)
+        del intersection
+
+        # The centres are selected from the largest values of the map, indexed by value
+        index = MaximumIndex(edtImage)
+
+    k = 0
+    while k < N:
+        with stage(profiler, "spherePlacement", sphere=k) as counts:
+            if coarseFactor is not None:
+                coarseRadius2, indices = index.maximum()
+                reach = np.sqrt(np.float64(coarseRadius2))
+                candidates = np.column_stack(np.unravel_index(indices, coarse.shape))
+                center, radius, tolerance = refineCenter(occupancy, shape, coarseRadius2, candidates, coarseFactor,
+                                                         centroid)
+                counts["radiusTolerance"] = tolerance * voxel_size
+                batch = [(center, radius)]
+            elif batchTolerance is not None:
+                batch = selectBatch(index, centroid, overlap, batchTolerance, N - k)
+                reach = batch[0][1]
+                counts["batch"] = len(batch)
+            else:
+                radius2, indices = index.maximum()
+
+                xyzCenter = np.column_stack(np.unravel_index(indices, shape))
+
+                dists = np.sqrt(np.sum(np.power(centroid - xyzCenter, 2), axis=1))
+                center = xyzCenter[np.argmax(dists)]
+                radius = np.sqrt(np.float64(radius2))
+                reach = radius
+                batch = [(center, radius)]
+
+            carved = []
+            for center, radius in batch:
+                if radius < rMin:
+                    print(f"The mimimum radius rMin={rMin} has been met using {k - 1} spheres")
+
+                # Carve the sphere only within its bounding box. Voxel coordinates are 1-based (as in MATLAB),
+                # so the carved sphere is centred one voxel below center.
+                sphCenter = center - 1
+                sphRadius = (1 - overlap) * radius
+                if occupancy is not None:
+                    box, inside = sphereBox(shape, sphCenter, sphRadius, sphRadius)
+                    carveOccupancy(occupancy, box, inside)
+                carved.append((sphCenter, sphRadius))
+
+                xyzC = center - halfSize + 1
+
+                clump.append(xyzC * voxel_size, radius * voxel_size)
+                k += 1
+            counts["radius"] = batch[0][1] * voxel_size
+
+        if k >= N:  # The distance map is not read after the last sphere
+            break
+
+        with stage(profiler, "edtIteration", sphere=k - 1, incremental=incrementalEDT):
+            if coarseFactor is not None:
+                if incrementalEDT:
+                    edtImage = updateCoarseEDT(edtImage, coarse, occupancy, box, coarseFactor, reach, index)
+                else:
+                    del edtImage, index
+                    coarse = coarsenOccupancy(unpackOccupancy(occupancy, tuple(slice(0, n) for n in shape)),
+                                              coarseFactor)
+                    edtImage = squaredEDT(coarse)
+                    index = MaximumIndex(edtImage)
+            elif incrementalEDT:
+                # The largest distance of the map never exceeds the radius of the first sphere of the batch
+                for sphCenter, sphRadius in carved:
+                    edtImage = updateEDT(edtImage, sphCenter, sphRadius, sphRadius + reach, index)
+            else:
+                del edtImage, index
+                edtImage = squaredEDT(unpackOccupancy(occupancy, tuple(slice(0, n) for n in shape)))
+                index = MaximumIndex(edtImage)
+
+    with stage(profiler, "export", spheres=clump.numSpheres):
+        output = kwargs.get('output')
+        if output is not None:
+            np.savetxt(output, np.asarray(np.hstack((clump.positions, clump.radii))),
+                       delimiter=",")  # In PyCharm this line seems to have an error but it does not. Known issue.
+
+        VTK = kwargs.get('VTK')
+        if VTK is not None:
+            clump_to_VTK(clump, filepath=output)
 
     visualise = kwargs.get('visualise')
     if visualise is not None:
@@ -3,6 +3,8 @@ import functions.utils.RigidBodyParameters as RigidBodyParameters
 import functions.utils.STLReader as STLReader
 from functions.utils.ClumpPlotter import clump_plotter_pyvista
 from functions.utils.VTK_writer import clump_to_VTK
+from functions.utils.Clump import Clump
+from functions.utils.Profiler import stage
 
 """
 Implementation of the clump-generation concept proposed by Favier et al. (1999) [1]
@@ -21,13 +23,42 @@ The default behaviour considers the minimum distance, although an optional param
 """
 
 
-class Clump:
-    def __init__(self):
-        self.positions = np.empty((0, 3))
-        self.radii = np.empty((0, 1))
-        self.minRadius = None
-        self.maxRadius = None
-        self.numSpheres = None
+def spanDistances(P, endPoints, midPoints):
+    """
+    Distances of the vertices within each span to the midpoint of the span, reduced to their minimum, average and
+    maximum value per span in one vectorised pass.
+
+    The vertices are sorted along X, so that the vertices of each span form a contiguous range. A vertex lying exactly
+    on the boundary of two spans belongs to both of them.
+
+    :param P: [V x 3] vertices of the particle, in principal axes (longest axis along X)
+    :param endPoints: [N+1] X coordinates of the end points of the spans
+    :param midPoints: [N] X coordinates of the midpoints of the spans
+    :return: distances: dictionary with the "min", "avg" and "max" distance of each span (nan for empty spans)
+             counts: [N] number of vertices within each span
+    """
+    order = np.argsort(P[:, 0], kind="stable")
+    xSorted = P[order, 0]
+
+    start = np.searchsorted(xSorted, endPoints[:-1], side="left")
+    stop = np.searchsorted(xSorted, endPoints[1:], side="right")
+    counts = stop - start
+
+    # Flatten the (span, vertex) pairs, span after span
+    span = np.repeat(np.arange(midPoints.size), counts)
+    offsets = np.cumsum(counts) - counts
+    vertex = order[np.arange(np.sum(counts)) - np.repeat(offsets, counts) + np.repeat(start, counts)]
+
+    distance = np.sqrt(np.square(P[vertex, 0] - midPoints[span]) + np.square(P[vertex, 1]) + np.square(P[vertex, 2]))
+
+    distances = {key: np.full(midPoints.size, np.nan) for key in ("min", "avg", "max")}
+    full = counts > 0
+    if np.any(full):
+        distances["min"][full] = np.minimum.reduceat(distance, offsets[full])
+        distances["max"][full] = np.maximum.reduceat(distance, offsets[full])
+        distances["avg"][full] = np.add.reduceat(distance, offsets[full]) / counts[full]
+
+    return distances, counts
 
 
 def GenerateClump_Favier(inputGeom, N, **kwargs):
@@ -40,10 +71,12 @@ def GenerateClump_Favier(inputGeom, N, **kwargs):
                         - img:			[Nx x Ny x Nz] voxelated image
                         - voxel_size:	[1x3] voxel size in Cartesian space
     :param N: Number of spheres to be generated.
-    :param kwargs: Can contain either of the optimal variables "chooseDistance", "output".
+    :param kwargs: Can contain either of the optimal variables "chooseDistance", "output", "profiler".
                 - chooseDistance: Preferred method to specify the radii of the spheres, which can be either the minimum ('min'),
                 the average ('avg') or the maximum ('max') distance of the vertices within the span of interest.
                 - File name for output of the clump in .txt form. If not assigned, a .txt output file is not created.
+                - profiler: Profiler (see functions.utils.Profiler), receiving the timing and the element counts of
+                each stage. If not assigned, nothing is measured.
     :return: mesh: structure containing all relevant parameters of polyhedron
                     mesh.vertices
                     mesh.faces
@@ -68,111 +101,86 @@ def GenerateClump_Favier(inputGeom, N, **kwargs):
 
     clump = Clump()  # instentiate Clump object for later use
 
-    F, P = STLReader.read_stl(inputGeom)  # read the STL file and get faces and vertices
+    profiler = kwargs.get('profiler')
+
+    with stage(profiler, "load") as counts:
+        F, P = STLReader.read_stl(inputGeom)  # read the STL file and get faces and vertices
+        counts.update(vertices=P.shape[0], faces=F.shape[0])
 
     # Build "mesh" structure
-    mesh = RigidBodyParameters.RBP(F, P)  # calculate the rigid body parameters based on F and P.
+    with stage(profiler, "RBP"):
+        mesh = RigidBodyParameters.RBP(F, P)  # calculate the rigid body parameters based on F and P.
 
     ################################################################################################
     #                                   Main Body of the Function                                  #
     ################################################################################################
 
-    # Center particle around its centroid and align it along its principal axes.
-    rot = mesh.PAI
-    # Singular value decomposition implementations in numpy and MATLAB give different results due to the
-    # freedom of choosing the basis vectors. To make them same I added two lines below. They can be removed
-    # without loss of generality. - Utku
-    rot *= -1
-    rot[:, 1] *= -1
-
-    # Transform rotation matrix to align longest axis along X direction
-    rot[:, [2, 0]] = rot[:, [0, 2]]
-
-    P = P - mesh.centroid
-    P = P @ rot
-
-    X_extremas = np.array([np.min(P[:, 0]), np.max(P[:, 0])])
-    a, b = X_extremas[0], X_extremas[1]
+    with stage(profiler, "spherePlacement", N=N) as stageCounts:
+        # Center particle around its centroid and align it along its principal axes.
+        rot = mesh.PAI
+        # Singular value decomposition implementations in numpy and MATLAB give different results due to the
+        # freedom of choosing the basis vectors. To make them same I added two lines below. They can be removed
+        # without loss of generality. - Utku
+        rot *= -1
+        rot[:, 1] *= -1
 
-    nSegments = N
+        # Transform rotation matrix to align longest axis along X direction
+        rot[:, [2, 0]] = rot[:, [0, 2]]
 
-    endPoints = np.linspace(a, b, nSegments + 1)  # 4 endpoints for 3 segments
-    start = endPoints[0:-1]  # 3 starting points
-    stop = endPoints[1::]  # 3 stopping points
-    midPoints = stop - (stop[0] - start[0]) / 2  # 3 middle points
+        P = P - mesh.centroid
+        P = P @ rot
 
-    minDistance = np.zeros(midPoints.size)
-    minDx = np.zeros(midPoints.size)
+        X_extremas = np.array([np.min(P[:, 0]), np.max(P[:, 0])])
+        a, b = X_extremas[0], X_extremas[1]
 
-    p_struct = {}  # MATLAB's struct is equivalent to Python's dictionary
-    for i in range(midPoints.size):  # For each midpoint
-        temp_arr = np.array([])  # I initialize an emtpy array to stack the values required below
+        nSegments = N
 
-        # Find vertices within each sector
-        for j in range(P.shape[0]):  # for each point of the particle surface (in principal axes)
-            if endPoints[i] <= P[j, 0] <= endPoints[i + 1]:
-                temp_arr = np.append(temp_arr, P[j, 0:3])  # I concatante the (3, 1) arrays
-        p_struct[i] = temp_arr.reshape(temp_arr.size // 3, 3)  # then I reshape the temp_arr to add it to p_struct
+        endPoints = np.linspace(a, b, nSegments + 1)  # 4 endpoints for 3 segments
+        start = endPoints[0:-1]  # 3 starting points
+        stop = endPoints[1::]  # 3 stopping points
+        midPoints = stop - (stop[0] - start[0]) / 2  # 3 middle points
 
-        # Find closest distance of midpoint to any surface vertex
-        xM, yM, zM = midPoints[i], 0, 0
-        x1 = endPoints[0]
-        x2 = endPoints[-1]
+        # Closest distance between each midpoint and the particle X limits
+        minDx = np.minimum(np.abs(endPoints[0] - midPoints), np.abs(endPoints[-1] - midPoints))
 
-        # Closest distance between midpoint and particle surface
-        minDistance[i] = np.min(
-            np.sqrt(
-                np.square(P[:, 0] - xM) + np.square(P[:, 1] - yM) + np.square(P[:, 2] - zM)))
+        distances, counts = spanDistances(P, endPoints, midPoints)
 
-        # Closest distane between midpoint and particle X limits
-        minDx[i] = np.min((np.abs(x1 - xM), np.abs(x2 - xM)))
-
-    # Build "clump" structure
-    radius = np.zeros(midPoints.size)
-    for i in range(midPoints.size):  # I skipped the isempty query.
-        distance = np.sqrt(np.square(p_struct[i][:, 0] - midPoints[i]) + np.square(p_struct[i][:, 1]) + np.square(
-            p_struct[i][:, 2]))
-
-        # I wrote the switch-case expression in old-school fashion for backward compability
+        # Build "clump" structure
         chooseDistance = kwargs.get('chooseDistance')
-        if chooseDistance == "min":
-            radius[i] = np.min(distance)
-        elif chooseDistance is None:
-            radius[i] = np.min(distance)
-        elif chooseDistance == "avg":
-            radius[i] = np.mean(distance)
-        elif chooseDistance == "max":
-            radius[i] = np.max(distance)
+        if chooseDistance is None:
+            chooseDistance = "min"
+
+        if chooseDistance in distances:
+            radius = np.minimum(distances[chooseDistance], minDx)
         else:
             print("Wrong optional parameter type for chooseDistance.")
+            radius = np.zeros(midPoints.size)
 
-        radius[i] = np.min((radius[i], minDx[i]))
-
-        clump.positions = np.vstack((clump.positions, np.array([midPoints[i], 0, 0])))
-        clump.radii = np.vstack((clump.radii, radius[i]))
+        # Spans without any vertices do not generate a sphere
+        full = counts > 0
+        clump.extend(np.column_stack((midPoints[full], np.zeros((np.sum(full), 2)))), radius[full])
 
-    # Transform the mesh and the clump coordinates back to the initial (non-principal) system
-    P = P @ np.transpose(rot)
-    P += mesh.centroid
+        # Transform the mesh and the clump coordinates back to the initial (non-principal) system
+        P = P @ np.transpose(rot)
+        P += mesh.centroid
 
-    clump.positions = clump.positions @ np.transpose(rot)
-    clump.positions += mesh.centroid
+        clump.positions = clump.positions @ np.transpose(rot)
+        clump.positions += mesh.centroid
 
-    clump.minRadius = np.min(clump.radii)
-    clump.maxRadius = np.max(clump.radii)
-    clump.numSpheres = len(clump.radii)
+        stageCounts["spheres"] = clump.numSpheres
 
     visualise = kwargs.get('visualise')
     if visualise is not None:
         clump_plotter_pyvista(clump)
 
-    VTK = kwargs.get('VTK')
-    if VTK is not None:
-        clump_to_VTK(clump)
+    with stage(profiler, "export", spheres=clump.numSpheres):
+        VTK = kwargs.get('VTK')
+        if VTK is not None:
+            clump_to_VTK(clump)
 
-    output = kwargs.get('output')
-    if output is not None:
-        np.savetxt(output, np.asarray(np.hstack((clump.positions, clump.radii))),
-                   delimiter=",")  # In PyCharm this line seems to have an error but it does not. Known issue.
+        output = kwargs.get('output')
+        if output is not None:
+            np.savetxt(output, np.asarray(np.hstack((clump.positions, clump.radii))),
+                       delimiter=",")  # In PyCharm this line seems to have an error but it does not. Known issue.
 
     return mesh, clump
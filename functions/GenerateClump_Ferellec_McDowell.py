@@ -4,6 +4,8 @@ import functions.utils.RigidBodyParameters as RigidBodyParameters
 import functions.utils.STLReader as STLReader
 from functions.utils.ClumpPlotter import clump_plotter_pyvista
 from functions.utils.VTK_writer import clump_to_VTK
+from functions.utils.Clump import Clump
+from functions.utils.Profiler import stage
 
 """
 Implementation of the clump-generation concept proposed by Ferellec and McDowell (2010) [1]
@@ -36,13 +38,92 @@ result to numerical instabilities when using DEM.
 """
 
 
-class Clump:
-    def __init__(self):
-        self.positions = np.empty((0, 3))
-        self.radii = np.empty((0, 1))
-        self.minRadius = None
-        self.maxRadius = None
-        self.numSpheres = None
+class SphereGrid:
+    """
+    Multi-level uniform grid hash of the centres of the generated spheres, used to find the spheres close to a vertex.
+
+    A sphere can be closer than dmin to a point only if its centre is closer than radius + dmin. Each sphere is stored
+    in the level whose cell size is the smallest power of two not below radius + dmin, so that only the 27 cells around
+    the point need to be checked in each level, even when the radii of the spheres differ by orders of magnitude.
+    The spheres themselves are read from the clump being generated.
+    """
+
+    def __init__(self, clump, dmin):
+        self.clump = clump
+        self.dmin = dmin
+        self.levels = {}  # level -> {cell -> list of sphere indices}
+
+    def add(self, index):
+        """
+        :param index: index of the new sphere in the clump
+        """
+        position, radius = self.clump.positions[index], self.clump.radii[index, 0]
+
+        level = int(np.ceil(np.log2(radius + self.dmin)))
+        cell = tuple(np.floor(position / 2.0 ** level).astype(int))
+        self.levels.setdefault(level, {}).setdefault(cell, []).append(index)
+
+    def minDistance(self, point):
+        """
+        :param point: [1 x 3] test point
+        :return: minimum distance of the point to the surface of the nearby spheres (negative inside a sphere), or
+                 inf if no sphere is within reach of dmin
+        """
+        ids = []
+        for level, cells in self.levels.items():
+            i, j, k = np.floor(point / 2.0 ** level).astype(int)
+            for di in (-1, 0, 1):
+                for dj in (-1, 0, 1):
+                    for dk in (-1, 0, 1):
+                        ids.extend(cells.get((i + di, j + dj, k + dk), ()))
+
+        if not ids:
+            return np.inf
+
+        return np.min(np.sqrt(np.sum(np.square(self.clump.positions[ids] - point), axis=1)) - self.clump.radii[ids, 0])
+
+
+def tangentRadii(P, N):
+    """
+    Radius of the largest sphere tangent to the particle surface at each vertex, computed directly instead of
+    incrementally increasing the radius by rstep.
+
+    A sphere tangent at vertex A, with centre A + r*n, contains another vertex B when r > |AB|^2 / (2*AB.n). Hence,
+    the largest tangent sphere at A is given by the minimum of this expression over all vertices with AB.n > 0.
+
+    :param P: [V x 3] vertices of the particle
+    :param N: [V x 3] inward vertex normals
+    :return: radii: [V] radius of the largest tangent sphere at each vertex (inf if no vertex lies in front of A)
+    """
+    # Distances are evaluated as |B|^2 - 2*A.B + |A|^2 in blocks of vertices, so that they reduce to matrix products.
+    # Coordinates are taken relative to the mean vertex to limit the round-off of this expansion.
+    P = np.asarray(P, dtype=float)
+    P = P - np.mean(P, axis=0)
+    N = N / np.linalg.norm(N, axis=1)[:, np.newaxis]
+    P2 = np.sum(P ** 2, axis=1)
+    tol = 64 * np.finfo(float).eps * np.max(np.abs(P))  # Round-off of A.n, B.n
+
+    radii = np.empty(P.shape[0])
+    chunkSize = max(1, 2 ** 22 // P.shape[0])  # vertices processed at once, to bound the [chunk x V] temporaries
+
+    for start in range(0, P.shape[0], chunkSize):
+        stop = min(start + chunkSize, P.shape[0])
+        A, n = P[start:stop], N[start:stop]
+
+        AB2 = A @ P.T
+        AB2 *= -2
+        AB2 += P2
+        AB2 += P2[start:stop, np.newaxis]
+
+        AD = n @ P.T
+        AD -= np.sum(A * n, axis=1)[:, np.newaxis]
+        AD *= 2
+        AD[np.arange(stop - start), np.arange(start, stop)] = 0  # A itself is not a candidate
+
+        radius = np.divide(AB2, AD, out=np.full(AD.shape, np.inf), where=AD > tol)
+        radii[start:stop] = np.min(radius, axis=1)
+
+    return radii
 
 
 def GenerateClump_Ferellec_McDowell(inputGeom: str, dmin: float, rmin: float, rstep: float, pmax: float, **kwargs):
@@ -52,9 +133,14 @@ def GenerateClump_Ferellec_McDowell(inputGeom: str, dmin: float, rmin: float, rs
     :param rmin: Minimum radius of sphere to be generated. For coarse meshes, the actual minimum radius might be >rmin.
     :param rstep: Step used to increase the radius in each iteration, until the generated sphere meets another point of the particle.
     :param pmax: Percentage of vertices which will be used to generate spheres. The selection of vertices is random.
-    :param kwargs: Can contain either of the optimal variables "seed", "output".
+    :param kwargs: Can contain either of the optimal variables "seed", "output", "exactRadius", "profiler".
                 - Seed value, used to achieve reproducible (random) results
                 - File name for output of the clump in .txt form. If not assigned, a .txt output file is not created.
+                - exactRadius: If True, the radius of each sphere is the exact radius of the largest sphere tangent at
+                the vertex, computed for all vertices in one vectorised pass, and rstep is not used. If False
+                (default), the radius is found by increasing it from rmin with a step of rstep.
+                - profiler: Profiler (see functions.utils.Profiler), receiving the timing and the element counts of
+                each stage. If not assigned, nothing is measured.
     :return: mesh: structure containing all relevant parameters of polyhedron
                     mesh.vertices
                     mesh.faces
@@ -82,27 +168,33 @@ def GenerateClump_Ferellec_McDowell(inputGeom: str, dmin: float, rmin: float, rs
 
     clump = Clump()  # instentiate Clump object for later use
 
-    F, P = STLReader.read_stl(inputGeom)  # read the STL file and get faces and vertices
+    profiler = kwargs.get('profiler')
+
+    with stage(profiler, "load") as counts:
+        F, P = STLReader.read_stl(inputGeom)  # read the STL file and get faces and vertices
+        counts.update(vertices=P.shape[0], faces=F.shape[0])
 
     # Build "mesh" structure
-    mesh = RigidBodyParameters.RBP(F, P)  # calculate the rigid body parameters based on F and P.
+    with stage(profiler, "RBP"):
+        mesh = RigidBodyParameters.RBP(F, P)  # calculate the rigid body parameters based on F and P.
 
-    N = PatchNormals.patch_normals(F, P)
+    with stage(profiler, "normals", vertices=P.shape[0]):
+        N = PatchNormals.patch_normals(F, P)
 
-    # Ensure the vertex normals are pointing inwards
-    """
-        ATTENTION: This approach is guaranteed to work only for convex polyhedra with manifold meshes.
-        For concave polyhedra, the vector of a random vertex to the centroid
-        does not necessarily reflect whether a face is poining inwards or outwards.
+        # Ensure the vertex normals are pointing inwards
+        """
+            ATTENTION: This approach is guaranteed to work only for convex polyhedra with manifold meshes.
+            For concave polyhedra, the vector of a random vertex to the centroid
+            does not necessarily reflect whether a face is poining inwards or outwards.
 
-        For concave particles, we can generate a tetrahedral mesh of the
-        particle from the surface mesh and use one of the non-parallel edges
-        of the adjacent tetrahedron to specify the inwards direction.
-    """
+            For concave particles, we can generate a tetrahedral mesh of the
+            particle from the surface mesh and use one of the non-parallel edges
+            of the adjacent tetrahedron to specify the inwards direction.
+        """
 
-    for i in range(P.shape[0]):
-        if np.dot((P[i, :]) - mesh.centroid, N[i, :]) > 0:
-            N[i, :] = -N[i, :]
+        for i in range(P.shape[0]):
+            if np.dot((P[i, :]) - mesh.centroid, N[i, :]) > 0:
+                N[i, :] = -N[i, :]
 
     Pmax = range(len(P))  # List of vertices indices
 
@@ -110,84 +202,94 @@ def GenerateClump_Ferellec_McDowell(inputGeom: str, dmin: float, rmin: float, rs
 
     tol = rmin / 1000  # Tolerance so that the starting vertex is considered outside the sphere
 
-    iCount = 0  # since I am stacking the arrays the counter param is not necessary
-    for _ in Pmax:
-        i = Vertices[iCount]
-        r = rmin
-        reachedMaxRadius = False
+    exactRadius = kwargs.get('exactRadius', False)
+    if exactRadius:
+        with stage(profiler, "tangentRadii", vertices=P.shape[0]):
+            radii = tangentRadii(P, N)
 
-        x, y, z = P[i, 0:3]
-        n = N[i, :]
+    grid = SphereGrid(clump, dmin)  # Spatial index of the generated spheres, used to check dmin
 
-        if iCount > 0 and dmin > 0:
-            dcur = np.min(
-                np.sqrt(np.square(x - clump.positions[:, 0].reshape(clump.positions.shape[0], 1))
-                        + np.square(y - clump.positions[:, 1].reshape(clump.positions.shape[0], 1))
-                        + np.square(z - clump.positions[:, 2].reshape(clump.positions.shape[0], 1)))
-                - clump.radii)
+    with stage(profiler, "spherePlacement", vertices=P.shape[0]) as counts:
+        iCount = 0  # since I am stacking the arrays the counter param is not necessary
+        for _ in Pmax:
+            i = Vertices[iCount]
+            r = rmin
+            reachedMaxRadius = False
 
-            if dcur < dmin:
-                iCount += 1
-                continue
+            x, y, z = P[i, 0:3]
+            n = N[i, :]
+
+            if iCount > 0 and dmin > 0:
+                dcur = grid.minDistance(P[i, 0:3])
+
+                if dcur < dmin:
+                    iCount += 1
+                    continue
 
-        while not reachedMaxRadius:
-            sphMin = 1e15
+            if exactRadius:
+                radius = radii[i]
 
-            while sphMin > -tol:
-                xC = x + r * n[0]
-                yC = y + r * n[1]
-                zC = z + r * n[2]
+                if not np.isfinite(radius):  # No vertex lies in front of the normal, i.e. the normal is not inwards
+                    iCount += 1
+                    continue
+            else:
+                while not reachedMaxRadius:
+                    sphMin = 1e15
 
-                distance = np.sqrt(np.square(P[:, 0] - xC)
-                                   + np.square(P[:, 1] - yC)
-                                   + np.square(P[:, 2] - zC))
-                sph = np.square(distance / r) - 1.0
-                sphMin = np.min(sph)
+                    while sphMin > -tol:
+                        xC = x + r * n[0]
+                        yC = y + r * n[1]
+                        zC = z + r * n[2]
 
-                r += rstep
+                        distance = np.sqrt(np.square(P[:, 0] - xC)
+                                           + np.square(P[:, 1] - yC)
+                                           + np.square(P[:, 2] - zC))
+                        sph = np.square(distance / r) - 1.0
+                        sphMin = np.min(sph)
 
-            reachedMaxRadius = True
-            indMin = np.argmin(sph)  # index of the minimum
+                        r += rstep
 
-            pointInside = P[indMin, :]
+                    reachedMaxRadius = True
+                    indMin = np.argmin(sph)  # index of the minimum
 
-            vAB = np.array([pointInside[0] - x, pointInside[1] - y, pointInside[2] - z])
-            vAD = np.dot(vAB, n) / np.linalg.norm(n)
+                    pointInside = P[indMin, :]
 
-            AB = np.linalg.norm(vAB)
-            AD = np.linalg.norm(vAD)
+                    vAB = np.array([pointInside[0] - x, pointInside[1] - y, pointInside[2] - z])
+                    vAD = np.dot(vAB, n) / np.linalg.norm(n)
 
-            radius = AB ** 2 / AD / 2
+                    AB = np.linalg.norm(vAB)
+                    AD = np.linalg.norm(vAD)
+
+                    radius = AB ** 2 / AD / 2
 
             xC = x + radius * n[0]
             yC = y + radius * n[1]
             zC = z + radius * n[2]
 
-            clump.positions = np.vstack((clump.positions, np.array([xC, yC, zC]).reshape((1, 3))))
-            clump.radii = np.vstack((clump.radii, radius))
+            clump.append(np.array([xC, yC, zC]), radius)
+            grid.add(clump.numSpheres - 1)
 
-        # Check whether the maximum percentage of vertices has been used
-        pcur = clump.radii.shape[0] / P.shape[0]  # Current percentage of vertices used
-        if pcur < pmax:
-            iCount += 1
-        else:
-            break
+            # Check whether the maximum percentage of vertices has been used
+            pcur = clump.numSpheres / P.shape[0]  # Current percentage of vertices used
+            if pcur < pmax:
+                iCount += 1
+            else:
+                break
 
-    clump.minRadius = np.min(clump.radii)
-    clump.maxRadius = np.max(clump.radii)
-    clump.numSpheres = len(clump.radii)
+        counts["spheres"] = clump.numSpheres
 
     visualise = kwargs.get('visualise')
     if visualise is not None:
         clump_plotter_pyvista(clump)
 
-    VTK = kwargs.get('VTK')
-    if VTK is not None:
-        clump_to_VTK(clump)
+    with stage(profiler, "export", spheres=clump.numSpheres):
+        VTK = kwargs.get('VTK')
+        if VTK is not None:
+            clump_to_VTK(clump)
 
-    output = kwargs.get('output')
-    if output is not None:
-        np.savetxt(output, np.asarray(np.hstack((clump.positions, clump.radii))),
-                   delimiter=",")  # In PyCharm this line seems to have an error but it does not. Known issue.
+        output = kwargs.get('output')
+        if output is not None:
+            np.savetxt(output, np.asarray(np.hstack((clump.positions, clump.radii))),
+                       delimiter=",")  # In PyCharm this line seems to have an error but it does not. Known issue.
 
     return mesh, clump
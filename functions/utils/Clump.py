@@ -0,0 +1,85 @@
+import numpy as np
+
+
+class Clump:
+    """
+    Structure containing all relevant clump parameters, shared by all clump generators.
+
+    The spheres are stored in preallocated contiguous arrays whose capacity is doubled when full, so that adding M
+    spheres one by one costs O(M) copies instead of O(M^2).
+
+    clump.positions		:	M-by-3 matrix containing the position of each generated sphere (view of the storage).
+    clump.radii			:	M-by-1 vector containing the radius of each generated sphere (view of the storage).
+    clump.minRadius		:	Minimum generated sphere (computed when accessed)
+    clump.maxRadius		:	Maximum generated sphere (computed when accessed)
+    clump.numSpheres	:	Total number of spheres
+    """
+
+    __slots__ = ("_positions", "_radii", "_count")
+
+    def __init__(self, capacity=16):
+        self._positions = np.empty((max(capacity, 1), 3))
+        self._radii = np.empty((max(capacity, 1), 1))
+        self._count = 0
+
+    def _reserve(self, capacity):
+        if capacity > self._radii.shape[0]:
+            capacity = max(capacity, 2 * self._radii.shape[0])
+            positions, radii = np.empty((capacity, 3)), np.empty((capacity, 1))
+            positions[:self._count] = self._positions[:self._count]
+            radii[:self._count] = self._radii[:self._count]
+            self._positions, self._radii = positions, radii
+
+    def append(self, position, radius):
+        """
+        Add one sphere to the clump.
+
+        :param position: [1 x 3] centre of the sphere
+        :param radius: radius of the sphere
+        """
+        self._reserve(self._count + 1)
+        self._positions[self._count] = np.ravel(position)
+        self._radii[self._count] = radius
+        self._count += 1
+
+    def extend(self, positions, radii):
+        """
+        Add several spheres to the clump.
+
+        :param positions: [K x 3] centres of the spheres
+        :param radii: [K] or [K x 1] radii of the spheres
+        """
+        positions = np.reshape(positions, (-1, 3))
+        self._reserve(self._count + positions.shape[0])
+        self._positions[self._count:self._count + positions.shape[0]] = positions
+        self._radii[self._count:self._count + positions.shape[0]] = np.reshape(radii, (-1, 1))
+        self._count += positions.shape[0]
+
+    @property
+    def positions(self):
+        return self._positions[:self._count]
+
+    @positions.setter
+    def positions(self, value):
+        # Assigning to the positions of the existing spheres, e.g. to transform the clump
+        self._positions[:self._count] = np.reshape(value, (self._count, 3))
+
+    @property
+    def radii(self):
+        return self._radii[:self._count]
+
+    @radii.setter
+    def radii(self, value):
+        self._radii[:self._count] = np.reshape(value, (self._count, 1))
+
+    @property
+    def numSpheres(self):
+        return self._count
+
+    @property
+    def minRadius(self):
+        return np.min(self.radii) if self._count > 0 else None
+
+    @property
+    def maxRadius(self):
+        return np.max(self.radii) if self._count > 0 else None
@@ -0,0 +1,227 @@
+import hashlib
+import inspect
+import os
+import tempfile
+import zipfile
+import numpy as np
+import trimesh
+from functions.utils.Clump import Clump
+from functions.utils.RigidBodyParameters import RBP, VoxelRBP
+from functions.utils.ClumpPlotter import clump_plotter_pyvista
+from functions.utils.VTK_writer import clump_to_VTK
+
+"""
+Content-addressed on-disk cache for generated clumps.
+
+Each entry is keyed by the hash of the content of the geometry file, the name of the generator and its parameters
+(including the seed), so that renaming or moving a geometry file does not invalidate the cache, while editing it does.
+The clump is stored in a compressed .npz file together with the mesh, as plain arrays (its vertices and faces, or the
+shape of its image, and its rigid body parameters), from which the mesh object is rebuilt on load; no pickled objects
+are stored or loaded. The total size of the cache is bounded: when it is exceeded, the least recently used entries are
+deleted.
+
+Calls of a random generator without a seed give a different clump each time, so they are not cached.
+"""
+
+CACHE_VERSION = 4
+
+# Optional variables of the generators which only control side effects (or profiling, threading) and do not change
+# the clump
+SIDE_EFFECTS = ("output", "visualise", "VTK", "profiler", "workers")
+
+# Generators whose clump is random unless the optional variable "seed" is given
+RANDOM = ("GenerateClump_Ferellec_McDowell",)
+
+# Generators which write the VTK file to the path of the output file, instead of the default path
+VTK_TO_OUTPUT = ("GenerateClump_Euclidean_3D",)
+
+# Rigid body parameters shared by all the mesh types
+MESH_PROPERTIES = ("volume", "centroid", "inertia_tensor", "eigs", "PAI")
+
+
+def mesh_to_arrays(mesh):
+    """
+    :param mesh: Mesh returned by a generator: trimesh.Trimesh, RBP or VoxelRBP
+    :return: Dictionary of plain arrays describing the mesh, with keys prefixed by "mesh_"
+    """
+    if isinstance(mesh, trimesh.Trimesh):  # Its mass properties are computed from its vertices and faces on demand
+        arrays = {"kind": "Trimesh", "vertices": mesh.vertices, "faces": mesh.faces}
+    elif isinstance(mesh, (RBP, VoxelRBP)):
+        arrays = {name: getattr(mesh, name) for name in MESH_PROPERTIES}
+        arrays["moments"] = np.array(mesh.moments[:10], dtype=float)
+        if isinstance(mesh, RBP):
+            arrays.update(kind="RBP", vertices=mesh.P, faces=mesh.F)
+        else:
+            arrays.update(kind="VoxelRBP", shape=mesh.shape, voxel_size=mesh.voxel_size, origin=mesh.origin)
+    else:
+        raise TypeError(f"Not recognised mesh type: {type(mesh).__name__}")
+
+    return {"mesh_" + name: np.asarray(value) for name, value in arrays.items()}
+
+
+def mesh_from_arrays(data):
+    """
+    Rebuild the mesh stored by mesh_to_arrays, without recomputing its rigid body parameters.
+
+    :param data: Mapping with the arrays returned by mesh_to_arrays
+    :return: mesh: trimesh.Trimesh, RBP or VoxelRBP
+    """
+    kind = str(data["mesh_kind"])
+
+    if kind == "Trimesh":
+        # The stored vertices and faces were already processed when the mesh was loaded
+        return trimesh.Trimesh(vertices=data["mesh_vertices"], faces=data["mesh_faces"], process=False)
+
+    if kind == "RBP":
+        mesh = RBP.__new__(RBP)
+        mesh.F, mesh.P = data["mesh_faces"], data["mesh_vertices"]
+    elif kind == "VoxelRBP":
+        mesh = VoxelRBP.__new__(VoxelRBP)
+        mesh.shape = tuple(data["mesh_shape"].tolist())
+        mesh.voxel_size, mesh.origin = float(data["mesh_voxel_size"]), data["mesh_origin"]
+    else:
+        raise ValueError(f"Not recognised mesh type: {kind}")
+
+    mesh.moments = tuple(data["mesh_moments"].tolist())
+    mesh.volume = float(data["mesh_volume"])
+    for name in MESH_PROPERTIES[1:]:
+        setattr(mesh, name, data["mesh_" + name])
+
+    return mesh
+
+
+class ClumpCache:
+    def __init__(self, directory, maxSize=2 ** 30):
+        """
+        :param directory: Directory where the cache entries are stored. It is created if it does not exist.
+        :param maxSize: Maximum total size of the cache entries, in bytes
+        """
+        self.directory = directory
+        self.maxSize = maxSize
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, generator, inputGeom, *args, **kwargs):
+        """
+        :return: hexadecimal key of the clump generated by generator(inputGeom, *args, **kwargs)
+        """
+        arguments = inspect.signature(generator).bind(inputGeom, *args, **kwargs).arguments
+        arguments.pop("inputGeom", None)
+        parameters = dict(arguments.pop("kwargs", {}), **arguments)
+        parameters = {name: value for name, value in parameters.items() if name not in SIDE_EFFECTS}
+
+        h = hashlib.sha256()
+        h.update(f"{CACHE_VERSION}|{generator.__name__}|{sorted(parameters.items())!r}|".encode())
+
+        if isinstance(inputGeom, str):
+            with open(inputGeom, "rb") as file:
+                for chunk in iter(lambda: file.read(2 ** 20), b""):
+                    h.update(chunk)
+        elif isinstance(inputGeom, np.ndarray):  # Voxelated image
+            h.update(f"{inputGeom.shape}|{inputGeom.dtype}|".encode())
+            h.update(np.ascontiguousarray(inputGeom).tobytes())
+        else:  # Struct with vertices and faces
+            for name in ("vertices", "faces"):
+                array = getattr(inputGeom, name, None)
+                if array is None:
+                    array = getattr(inputGeom, name.capitalize())
+                h.update(np.ascontiguousarray(array).tobytes())
+
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".npz")
+
+    def load(self, key):
+        """
+        :return: (mesh, clump) stored under key, or None if there is no such entry
+        """
+        path = self.path(key)
+        try:
+            with np.load(path) as data:
+                clump = Clump(capacity=data["radii"].shape[0])
+                clump.extend(data["positions"], data["radii"])
+                mesh = mesh_from_arrays(data)
+
+            os.utime(path)  # Mark as recently used
+        except FileNotFoundError:  # No such entry, or evicted by another process
+            return None
+        except (OSError, EOFError, KeyError, ValueError, zipfile.BadZipFile):  # Truncated or corrupt entry
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            return None
+
+        return mesh, clump
+
+    def store(self, key, mesh, clump):
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as file:
+            np.savez_compressed(file, positions=clump.positions, radii=clump.radii, **mesh_to_arrays(mesh))
+        os.replace(tmp, self.path(key))  # Atomic, so that concurrent processes never read a partial entry
+
+        self.evict()
+
+    def evict(self):
+        """
+        Delete the least recently used entries until the total size of the cache does not exceed maxSize.
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".npz"):
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except FileNotFoundError:  # Deleted by another process
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+
+        size = sum(entry[1] for entry in entries)
+        for _, entrySize, name in sorted(entries):
+            if size <= self.maxSize:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+            size -= entrySize
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            if name.endswith(".npz"):
+                os.remove(os.path.join(self.directory, name))
+
+    def generate(self, generator, inputGeom, *args, **kwargs):
+        """
+        Same as generator(inputGeom, *args, **kwargs), e.g. GenerateClump_Euclidean_3D(inputGeom, N, rMin, div,
+        overlap, **kwargs), but the result is read from the cache if the same clump has been generated before.
+
+        :return: mesh, clump
+        """
+        if generator.__name__ in RANDOM and kwargs.get("seed") is None:  # A different clump at each call
+            return generator(inputGeom, *args, **kwargs)
+
+        key = self.key(generator, inputGeom, *args, **kwargs)
+
+        result = self.load(key)
+        if result is None:
+            mesh, clump = generator(inputGeom, *args, **kwargs)
+            self.store(key, mesh, clump)
+            return mesh, clump
+
+        # Reproduce the side effects of the generator
+        mesh, clump = result
+
+        output = kwargs.get('output')
+        if output is not None:
+            np.savetxt(output, np.asarray(np.hstack((clump.positions, clump.radii))), delimiter=",")
+
+        if kwargs.get('VTK') is not None:
+            if generator.__name__ in VTK_TO_OUTPUT:
+                clump_to_VTK(clump, filepath=output)
+            else:
+                clump_to_VTK(clump)
+
+        if kwargs.get('visualise') is not None:
+            clump_plotter_pyvista(clump)
+
+        return mesh, clump
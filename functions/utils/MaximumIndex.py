@@ -0,0 +1,112 @@
+import heapq
+import numpy as np
+
+
+class MaximumIndex:
+    """
+    Bucketed index of the largest values of a non-increasing voxel map (e.g. a squared Euclidean distance map which is
+    only ever carved), to find its maximum and all the voxels attaining it without scanning the whole map.
+
+    The voxels whose value is at least a threshold are stored in buckets keyed by their value, and the keys in a
+    max-heap. Invariant: every voxel whose current value v is at least the threshold has an entry in the bucket of v.
+    When values decrease, the new values are added to their buckets and the old entries become stale; stale entries
+    are discarded when their bucket reaches the top of the heap. When all the indexed voxels have fallen below the
+    threshold, the index is rebuilt from a single scan of the map, with a lower threshold.
+
+    index.values	:	Map, read by the index and updated in place by the caller
+    index.threshold	:	Smallest value currently indexed
+    """
+
+    __slots__ = ("values", "fraction", "threshold", "_flat", "_buckets", "_heap", "_dtype")
+
+    def __init__(self, values, fraction=0.25):
+        """
+        :param values: C-contiguous voxel map, with non-negative values. Its values must only decrease afterwards,
+                       and each decrease must be reported with update.
+        :param fraction: Threshold of the index, relative to the maximum of the map when the index is (re)built
+        """
+        if not values.flags.c_contiguous:
+            raise ValueError("The map of a MaximumIndex must be C-contiguous.")
+
+        self.values = values
+        self.fraction = fraction
+        self._flat = values.reshape(-1)
+        self._dtype = np.int32 if values.size < 2 ** 31 else np.int64
+        self.rebuild()
+
+    def rebuild(self):
+        maximum = np.max(self.values)
+        self.threshold = maximum * self.fraction if maximum > 0 else maximum
+        self._buckets = {}
+        self._heap = []
+        self._add(np.flatnonzero(self.values >= self.threshold))
+
+    def _add(self, indices):
+        if indices.size == 0:
+            return
+
+        values = self._flat[indices]
+        order = np.argsort(values, kind='stable')
+        indices, values = indices[order].astype(self._dtype), values[order]
+
+        keys, starts = np.unique(values, return_index=True)
+        for key, entries in zip(keys.tolist(), np.split(indices, starts[1:])):
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                self._buckets[key] = [entries]
+                heapq.heappush(self._heap, -key)
+            else:
+                bucket.append(entries)
+
+    def update(self, box, changed):
+        """
+        Register the voxels of a sub-box of the map whose values have decreased.
+
+        :param box: tuple of slices (with explicit bounds) of the sub-box
+        :param changed: Boolean array with the shape of the sub-box, True for the voxels whose value decreased
+        """
+        local = np.nonzero(changed & (self.values[box] >= self.threshold))
+        if local[0].size:
+            self._add(np.ravel_multi_index(tuple(i + b.start for i, b in zip(local, box)), self.values.shape))
+
+    def maximum(self):
+        """
+        :return: maximum: Maximum value of the map
+                 indices: Sorted flat indices of the voxels whose value is the maximum, i.e. in the order of
+                          np.argwhere(values == maximum)
+        """
+        while True:
+            while self._heap:
+                key = -self._heap[0]
+                entries = np.concatenate(self._buckets[key])
+                entries = entries[self._flat[entries] == key]  # Discard the stale entries
+
+                if entries.size:
+                    entries.sort()
+                    self._buckets[key] = [entries]
+                    return self.values.dtype.type(key), entries
+
+                del self._buckets[key]
+                heapq.heappop(self._heap)
+
+            self.rebuild()
+
+    def candidates(self, minimum):
+        """
+        :param minimum: Smallest value of the returned voxels
+        :return: values: Values of the indexed voxels whose value is at least minimum. If minimum is below the
+                         threshold, the voxels below the threshold are not included.
+                 indices: Flat indices of these voxels
+        """
+        self.maximum()  # Ensures that the index is not empty
+
+        values, indices = [], []
+        for key in [key for key in self._buckets if key >= minimum]:
+            entries = np.concatenate(self._buckets[key])
+            entries = entries[self._flat[entries] == key]
+            self._buckets[key] = [entries]
+
+            values.append(np.full(entries.size, key, dtype=self.values.dtype))
+            indices.append(entries)
+
+        return np.concatenate(values), np.concatenate(indices)
@@ -1,43 +1,48 @@
 import numpy as np
-import time
 from scipy.spatial import Delaunay
+from functions.utils.Profiler import stage
 
 
-def MyRobustCrust(p):
+def MyRobustCrust(p, profiler=None):
+    """
+    :param p: [N x 3] points sampled on the surface
+    :param profiler: Optional Profiler, receiving the timing and the element counts of each stage
+    :return:    t: triangles of the reconstructed surface, as indices of p
+                tnorm: outward unit normal of each triangle
+    """
     # error check
     if len(p.shape) > 2 or p.shape[1] != 3:
         raise ValueError("Input 3D points must be stored in a Nx3 array")
 
     # add points to the given ones, this is useful to create outside tetrahedrons
-    start = time.time()
-    p, nshield = AddShield(p)
-    print(f'Added Shield: {time.time() - start} s')
-
-    start = time.time()
-    # https://stackoverflow.com/questions/36604172/difference-between-matlab-delaunayn-and-scipy-delaunay
-    tetr = matlab_delaunayn(p)
+    with stage(profiler, "shield", points=p.shape[0]) as counts:
+        p, nshield = AddShield(p)
+        counts["shieldPoints"] = nshield
 
-    print(f'Delaunay Triangulation Time: {time.time() - start} s')
+    with stage(profiler, "delaunay", points=p.shape[0]) as counts:
+        # https://stackoverflow.com/questions/36604172/difference-between-matlab-delaunayn-and-scipy-delaunay
+        tetr = matlab_delaunayn(p)
+        counts["tetrahedrons"] = tetr.shape[0]
 
     # find triangles to tetrahedron and tetrahedron to triangles connectivity data
-    start = time.time()
-    t2tetr, tetr2t, t = Connectivity(tetr)
-    print(f'Connectivity Time: {time.time() - start} s')
+    with stage(profiler, "connectivity", tetrahedrons=tetr.shape[0]) as counts:
+        t2tetr, tetr2t, t = Connectivity(tetr)
+        counts["triangles"] = t.shape[0]
 
-    start = time.time()
-    cc, r = CC(p, tetr)  # Circumcenters of tetrahedrons
-    print(f'Circumcenters Time: {time.time() - start} s')
+    with stage(profiler, "circumcenters", tetrahedrons=tetr.shape[0]):
+        cc, r = CC(p, tetr)  # Circumcenters of tetrahedrons
 
-    start = time.time()
-    tbound, _ = Marking(p, tetr, tetr2t, t2tetr, cc, r, nshield)  # Flagging tetrahedrons as inside or outside
-    print(f'Walking Time: {time.time() - start} s')
+    with stage(profiler, "marking", tetrahedrons=tetr.shape[0]) as counts:
+        tbound, _, stats = Marking(p, tetr, tetr2t, t2tetr, cc, r, nshield)  # Flagging tetrahedrons as inside or outside
+        counts.update(stats)
+        counts["boundaryTriangles"] = int(np.sum(tbound))
 
     # reconstructed raw surface
     t = t[tbound]
 
-    start = time.time()
-    t, tnorm = ManifoldExtraction(t, p)
-    print(f'Manifold extraction Time: {time.time() - start} s')
+    with stage(profiler, "manifoldExtraction", triangles=t.shape[0]) as counts:
+        t, tnorm = ManifoldExtraction(t, p)
+        counts["manifoldTriangles"] = t.shape[0]
 
     return t, tnorm
 
@@ -98,55 +103,55 @@ def ManifoldExtraction(t, p):  # WORKS
     numt = t.shape[0]  # number of triangles
     vect = np.arange(numt)
     e = np.vstack([t[:, [0, 1]], t[:, [1, 2]], t[:, [2, 0]]])
-    e, j = np.unique(np.sort(e, axis=1), axis=0, return_inverse=True)
+    e, j = UniqueRows(np.sort(e, axis=1))
 
     # Unique edges
     te = np.vstack([j[vect], j[vect + numt], j[vect + 2 * numt]]).T
 
     nume = e.shape[0]
-    e2t = np.zeros((nume, 2), dtype=np.int32)
-    ne = e.shape[0]
-    # np_ = p.shape[0]
-    count = np.zeros(ne, dtype=np.int32)
-    etmapc = np.zeros((ne, 4), dtype=np.int32)
 
-    for i in range(numt):
-        i1, i2, i3 = te[i, :]
-        etmapc[i1, count[i1]] = i
-        etmapc[i2, count[i2]] = i
-        etmapc[i3, count[i3]] = i
-
-        count[i1] += 1
-        count[i2] += 1
-        count[i3] += 1
-
-    etmap = [etmapc[i, :count[i]].tolist() for i in range(ne)]
-    tkeep = np.zeros(numt, dtype=bool)
+    # edge-to-triangles connectivity: the triangles of edge k are etmap[etmapptr[k]:etmapptr[k + 1]]
+    etmapptr, etmap = GroupIndices(te.ravel(), nume)
+    etmap //= 3
+    count = np.diff(etmapptr)
 
+    # Orientation of each triangle, as the sign of its normal with respect to the normal given by Tnorm
     tnorm = Tnorm(p, t)
+    sign = np.ones(numt)
+
+    # Dihedral angles between every ordered pair (t1, t2) of triangles sharing an edge, computed in batch as in
+    # TriAngle. The pair of the i-th and j-th triangles of edge k is stored at pairptr[k] + i * count[k] + j.
+    alpha, test, testor, flip, pairptr = DihedralAngles(p, t, tnorm, e, etmap, etmapptr)
 
     t1 = np.argmax(np.sum(p[t, 2], axis=1) / 3)
     if tnorm[t1, 2] < 0:
-        tnorm[t1, :] = -tnorm[t1, :]
+        sign[t1] = -1
+
+    # The front propagation visits one edge at a time, so plain lists are faster to index than arrays
+    te, etmap, etmapptr, count = te.tolist(), etmap.tolist(), etmapptr.tolist(), count.tolist()
+    alpha, test, testor, flip, pairptr = alpha.tolist(), test.tolist(), testor.tolist(), flip.tolist(), pairptr.tolist()
+    sign = sign.tolist()
+
+    tkeep = [False] * numt
+    e2t1 = [0] * nume  # first triangle of each edge
+    e2t2 = [0] * nume  # second triangle of each edge
 
     tkeep[t1] = True
-    efront = np.zeros(nume, dtype=np.int32)
-    efront[:3] = te[t1, :]
-    e2t[te[t1, :], 0] = t1
+    efront = [0] * nume
+    efront[:3] = te[t1]
+    for ide in te[t1]:
+        e2t1[ide] = t1
     nf = 2
 
     while nf > 0:
         k = efront[nf]
-        if e2t[k, 1] > 0 or e2t[k, 0] < 1 or count[k] < 2:
+        if e2t2[k] > 0 or e2t1[k] < 1 or count[k] < 2:
             nf -= 1
             continue
 
-        idtcandidate = etmap[k]
-        t1 = e2t[k, 0]
-        ttemp = t[t1, :]
-        etemp = e[k, :]
-        p1, p2 = etemp
-        p3 = ttemp[(ttemp != p1) & (ttemp != p2)][0]
+        t1 = e2t1[k]
+        idtcandidate = etmap[etmapptr[k]:etmapptr[k + 1]]
+        pair = pairptr[k] + idtcandidate.index(t1) * count[k]
 
         alphamin = np.inf
         for i in range(len(idtcandidate)):
@@ -154,39 +159,82 @@ def ManifoldExtraction(t, p):  # WORKS
             if t2 == t1:
                 continue
 
-            ttemp = t[t2, :]
-            p4 = ttemp[(ttemp != p1) & (ttemp != p2)][0]
-            alpha, tnorm2 = TriAngle(p[p1, :], p[p2, :], p[p3, :], p[p4, :], tnorm[t1, :])
+            # Adjust the angle if p4 is below the plane of t1, with the current orientation of t1
+            if sign[t1] * test[pair + i] < 0:
+                angle = alpha[pair + i] + 2 * (np.pi - alpha[pair + i])
+            else:
+                angle = alpha[pair + i]
 
-            if alpha < alphamin:
-                alphamin = alpha
+            if angle < alphamin:
+                alphamin = angle
                 idt = t2
-                tnorm[t2, :] = tnorm2
+                # Orient t2 consistently with t1
+                sign[t2] = -flip[pair + i] if sign[t1] * testor[pair + i] > 0 else flip[pair + i]
 
         tkeep[idt] = True
-        for j in range(3):
-            ide = te[idt, j]
-
+        for ide in te[idt]:
             if ide == 0:
                 break
 
-            if e2t[ide, 0] < 1:  # Is it the first triangle for the current edge?
-                efront[nf] = ide
-                nf += 1
-                e2t[ide, 0] = idt
+            efront[nf] = ide
+            nf += 1
+            if e2t1[ide] < 1:  # Is it the first triangle for the current edge?
+                e2t1[ide] = idt
             else:  # No, it is the second one
-                efront[nf] = ide
-                nf += 1
-                e2t[ide, 1] = idt
+                e2t2[ide] = idt
 
         nf -= 1
 
+    tkeep = np.array(tkeep)
     t = t[tkeep, :]
-    tnorm = tnorm[tkeep, :]
+    tnorm = tnorm[tkeep, :] * np.array(sign)[tkeep, np.newaxis]
 
     return t, tnorm
 
 
+def DihedralAngles(p, t, tnorm, e, etmap, etmapptr):
+    """
+    Computes, in batch, the quantities of TriAngle for every ordered pair of triangles (t1, t2) sharing an edge.
+
+    :param tnorm: Normals of the triangles, as computed by Tnorm
+    :return:    alpha: angle between the two triangles, before the adjustment for p4 lying below the plane of t1
+                test: position of p4 with respect to the plane of t1, oriented by the normal of Tnorm
+                testor: dot product of the normal of Tnorm of t1 with the normal of t1 computed by TriAngle
+                flip: sign of the normal of t2 computed by TriAngle, with respect to the normal of Tnorm
+                pairptr: the pair of the i-th and j-th triangles of edge k is stored at pairptr[k] + i * count[k] + j
+    """
+    count = np.diff(etmapptr)
+    pairptr = np.zeros(count.size + 1, dtype=np.int64)
+    np.cumsum(count ** 2, out=pairptr[1:])
+
+    # All ordered pairs (i, j) of the triangles of each edge
+    edge = np.repeat(np.arange(count.size), count ** 2)
+    local = np.arange(pairptr[-1]) - pairptr[edge]
+    i, j = local // count[edge], local % count[edge]
+    tri1 = etmap[etmapptr[edge] + i]
+    tri2 = etmap[etmapptr[edge] + j]
+
+    # Vertices: p1, p2 on the common edge, p3 and p4 the third vertices of t1 and t2
+    p1, p2 = e[edge, 0], e[edge, 1]
+    p3 = np.sum(t[tri1], axis=1) - p1 - p2
+    p4 = np.sum(t[tri2], axis=1) - p1 - p2
+    p1, p2, p3, p4 = p[p1], p[p2], p[p3], p[p4]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        v21 = p1 - p2
+        tnorm1 = np.cross(v21, p3 - p1)
+        tnorm1 /= np.linalg.norm(tnorm1, axis=1)[:, np.newaxis]
+        tnorm2 = np.cross(v21, p4 - p1)
+        tnorm2 /= np.linalg.norm(tnorm2, axis=1)[:, np.newaxis]
+
+        alpha = np.arccos(np.clip(np.sum(tnorm1 * tnorm2, axis=1), -1, 1))
+        test = np.sum(tnorm[tri1] * (p4 - p3), axis=1)
+        testor = np.sum(tnorm[tri1] * tnorm1, axis=1)
+        flip = np.sign(np.sum(tnorm[tri2] * tnorm2, axis=1))
+
+    return alpha, test, testor, flip, pairptr
+
+
 def CC(p, tetr):
     # Finds circumcenters from a set of tetrahedrons
 
@@ -236,23 +284,69 @@ def Connectivity(tetr):
     numt = tetr.shape[0]
     vect = np.arange(numt)
     t = np.vstack([tetr[:, [0, 1, 2]], tetr[:, [1, 2, 3]], tetr[:, [0, 2, 3]], tetr[:, [0, 1, 3]]])  # triangles not unique
-    t, j = np.unique(np.sort(t, axis=1), return_inverse=True, axis=0)  # triangles
+    t, j = UniqueRows(np.sort(t, axis=1))  # triangles
     t2tetr = np.vstack([j[vect], j[vect + numt], j[vect + 2 * numt], j[vect + 3 * numt]]).T  # each tetrahedron has 4 triangles
 
-    # triang-to-tetr connectivity
+    # triang-to-tetr connectivity: each triangle belongs to one or two tetrahedrons, listed in increasing order
     nume = t.shape[0]
+    ptr, idx = GroupIndices(t2tetr.ravel(), nume)
+    count = np.diff(ptr)
+
     tetr2t = np.zeros((nume, 2), dtype=np.int32)
-    count = np.ones(nume, dtype=np.int8)
-    for k in range(numt):
-        for j in range(4):
-            ce = t2tetr[k, j]
-            tetr2t[ce, count[ce] - 1] = k
-            count[ce] += 1
+    tetr2t[:, 0] = idx[ptr[:-1]] // 4
+    tetr2t[count > 1, 1] = idx[ptr[:-1][count > 1] + 1] // 4
 
     return t2tetr, tetr2t, t
 
 
+def UniqueRows(a):
+    """
+    Same as np.unique(a, axis=0, return_inverse=True) for an array of non-negative integer indices, but each row is
+    first encoded into a single int64 key so that a 1D sort is used instead of a lexicographic row sort.
+    """
+    base = int(np.max(a)) + 1 if a.size else 1
+    if base ** a.shape[1] >= np.iinfo(np.int64).max:  # the key would overflow
+        return np.unique(a, axis=0, return_inverse=True)
+
+    keys = np.zeros(a.shape[0], dtype=np.int64)
+    for col in range(a.shape[1]):
+        keys = keys * base + a[:, col]
+
+    _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+
+    return a[first], inverse
+
+
+def GroupIndices(keys, n):
+    """
+    Groups the positions of an array of keys by key value, in CSR form.
+
+    :param keys: 1D array of integer keys in [0, n)
+    :param n: number of possible key values
+    :return:    ptr: [n + 1] array. The positions of the entries with key k are idx[ptr[k]:ptr[k + 1]].
+                idx: positions in keys, sorted by key and, within each key, in increasing order
+    """
+    idx = np.argsort(keys, kind='stable')
+    ptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(keys, minlength=n), out=ptr[1:])
+
+    return ptr, idx
+
+
 def Marking(p, tetr, tetr2t, t2tetr, cc, r, nshield):
+    """
+    Flags tetrahedrons as inside or outside, walking from the outside tetrahedrons (with shield points) through the
+    triangles on the front, one tolerance level at a time.
+
+    :return:    tbound: boolean mask of the boundary triangles
+                Ifact: intersection factor of each triangle
+                stats: dictionary with the statistics of the walk
+                    levels: number of levels walked
+                    frontSize: number of triangles on the front at each level
+                    newlyChecked: number of tetrahedrons flagged at each level
+                    bruteContinuation: whether the brute continuation was necessary
+                    checkedFraction: fraction of tetrahedrons that were flagged
+    """
     # constants for the algorithm
     TOLLDIFF = .01
     INITTOLL = .99
@@ -268,9 +362,7 @@ def Marking(p, tetr, tetr2t, t2tetr, cc, r, nshield):
     deleted = np.any(tetr > np_, axis=1)
     checked = deleted.copy()
     onfront = np.zeros(nt, dtype=bool)
-
-    for i in np.where(checked)[0]:
-        onfront[t2tetr[i, :]] = True
+    onfront[t2tetr[checked].ravel()] = True
 
     countchecked = np.sum(checked)
 
@@ -281,67 +373,107 @@ def Marking(p, tetr, tetr2t, t2tetr, cc, r, nshield):
     # intersection factor
     Ifact = IntersectionFactor(tetr2t, cc, r)
 
-    ids = np.arange(nt)
-    queue = ids[onfront]
-    nt = len(queue)
+    stats = {'levels': 0, 'frontSize': [], 'newlyChecked': [], 'bruteContinuation': False, 'checkedFraction': 0.0}
+
+    queue = np.flatnonzero(onfront)
     while countchecked < numtetr and level < MAXLEVEL:
         level += 1
 
-        for i in range(nt):
-            id_ = queue[i]
-            tetr1, tetr2 = tetr2t[id_]
+        newlyChecked = MarkingLevel(queue, tetr2t, t2tetr, Ifact.ravel(), toll, TOLLDIFF, checked, deleted, onfront)
+        countchecked += newlyChecked
 
-            if tetr2 == 0 or (checked[tetr1] and checked[tetr2]):
-                onfront[id_] = False
-                continue
-
-            if Ifact[id_] >= toll[id_]:  # flag as equal
-                if checked[tetr1]:
-                    deleted[tetr2] = deleted[tetr1]
-                    checked[tetr2] = True
-                    countchecked += 1
-                    onfront[t2tetr[tetr2]] = True
-                else:
-                    deleted[tetr1] = deleted[tetr2]
-                    checked[tetr1] = True
-                    countchecked += 1
-                    onfront[t2tetr[tetr1]] = True
-                onfront[id_] = False
-
-            elif Ifact[id_] < -toll[id_]:  # flag as different
-                if checked[tetr1]:
-                    deleted[tetr2] = not deleted[tetr1]
-                    checked[tetr2] = True
-                    countchecked += 1
-                    onfront[t2tetr[tetr2]] = True
-                else:
-                    deleted[tetr1] = not deleted[tetr2]
-                    checked[tetr1] = True
-                    countchecked += 1
-                    onfront[t2tetr[tetr1]] = True
-                onfront[id_] = False
-
-            else:
-                toll[id_] -= TOLLDIFF
+        stats['frontSize'].append(queue.size)
+        stats['newlyChecked'].append(newlyChecked)
 
         if level == BRUTELEVEL:
-            print('Brute continuation necessary')
-            onfront[np.any(t2tetr[~checked], axis=0)] = True
+            stats['bruteContinuation'] = True
+            onfront[t2tetr[~checked].ravel()] = True
 
-        queue = ids[onfront]
-        nt = len(queue)
+        queue = np.flatnonzero(onfront)
 
     # extract boundary triangles
     tbound = BoundTriangles(tetr2t, deleted)
 
-    if level == MAXLEVEL:
-        print(f'{level} th level was reached')
-    else:
-        print(f'{level} th level was reached')
+    stats['levels'] = level
+    stats['checkedFraction'] = countchecked / numtetr
+
+    return tbound, Ifact, stats
+
 
-    print(f'{countchecked / numtetr * 100:.4f} % of tetrahedrons were checked')
+def MarkingLevel(queue, tetr2t, t2tetr, Ifact, toll, TOLLDIFF, checked, deleted, onfront):
+    """
+    Processes one level of the walk of Marking over the triangles of the front, updating toll, checked, deleted and
+    onfront in place. The result is the same as visiting the triangles of the queue one after the other.
+
+    Two triangles of the queue only interact through a tetrahedron that is not checked at the start of the level.
+    Each triangle is therefore processed as soon as the previous triangles of the queue sharing such a tetrahedron
+    have been processed, so that every round handles a set of independent triangles with array operations.
 
-    return tbound, Ifact
+    :return: number of tetrahedrons flagged in this level
+    """
+    nq = queue.size
+    pos = np.arange(nq)
+    tetr1 = tetr2t[queue, 0]
+    tetr2 = tetr2t[queue, 1]
+
+    active = tetr2 != 0  # Triangles with a single tetrahedron are just removed from the front
+
+    # Previous triangle of the queue sharing each (unchecked) tetrahedron of each triangle
+    entTetr = np.concatenate((tetr1[active], tetr2[active]))
+    entPos = np.concatenate((pos[active], pos[active]))
+    entSide = np.repeat([0, 1], np.sum(active))
+    unchecked = ~checked[entTetr]
+    entTetr, entPos, entSide = entTetr[unchecked], entPos[unchecked], entSide[unchecked]
+
+    order = np.lexsort((entPos, entTetr))
+    entTetr, entPos, entSide = entTetr[order], entPos[order], entSide[order]
+    sameAsPrevious = np.zeros(entTetr.size, dtype=bool)
+    sameAsPrevious[1:] = entTetr[1:] == entTetr[:-1]
+
+    previous = np.full((nq, 2), -1)
+    previous[entPos[sameAsPrevious], entSide[sameAsPrevious]] = entPos[np.flatnonzero(sameAsPrevious) - 1]
+
+    pending = active.copy()
+    removed = ~active  # Triangles removed from the front while processed
+    flagged = np.full(nq, -1)  # Tetrahedron flagged by each triangle
+
+    while np.any(pending):
+        ready = pending & ((previous[:, 0] < 0) | ~pending[previous[:, 0]]) \
+                        & ((previous[:, 1] < 0) | ~pending[previous[:, 1]])
+        i = np.flatnonzero(ready)
+        ids = queue[i]
+        t1, t2 = tetr1[i], tetr2[i]
+        checked1 = checked[t1]
+
+        both = checked1 & checked[t2]
+        equal = ~both & (Ifact[ids] >= toll[ids])  # flag as equal
+        different = ~both & ~equal & (Ifact[ids] < -toll[ids])  # flag as different
+        undecided = ~both & ~equal & ~different
+
+        toll[ids[undecided]] -= TOLLDIFF
+
+        flag = equal | different
+        source = np.where(checked1, t1, t2)[flag]
+        target = np.where(checked1, t2, t1)[flag]
+        deleted[target] = deleted[source] ^ different[flag]
+        checked[target] = True
+
+        flagged[i[flag]] = target
+        removed[i[both | flag]] = True
+        pending[i] = False
+
+    # The triangles of every flagged tetrahedron are put on the front, and processed triangles are removed from it.
+    # The final state of each triangle is given by the last of these events in the order of the queue.
+    isFlagged = flagged >= 0
+    frontTime = np.full(onfront.size, -1)
+    np.maximum.at(frontTime, t2tetr[flagged[isFlagged]].ravel(), np.repeat(pos[isFlagged], 4))
+    removedTime = np.full(onfront.size, -1)
+    removedTime[queue[removed]] = pos[removed]
+
+    onfront[frontTime > removedTime] = True
+    onfront[(removedTime >= 0) & (removedTime >= frontTime)] = False
+
+    return int(np.sum(isFlagged))
 
 
 def AddShield(p):
@@ -468,7 +600,19 @@ def merge_duplicate_points(X):
     return X, dupes_found, idx_map
 
 
-def matlab_delaunayn(x):
+def matlab_delaunayn(x, report=False):
+    """
+    Delaunay triangulation following the conventions of MATLAB's delaunayn.
+
+    :param x: [m x n] points
+    :param report: If True, also return a dictionary describing the simplices that were dropped
+    :return:    t: simplices of the triangulation, as indices of x
+                info: (only if report is True) dictionary with the entries
+                    duplicatePoints: number of duplicate points merged before the triangulation
+                    simplices: number of simplices produced by qhull
+                    zeroVolume: number of simplices dropped because their volume is exactly zero
+                    belowTolerance: number of simplices dropped because their volume is within round-off of zero
+    """
     if x is None:
         raise ValueError('Not Enough Inputs')
 
@@ -477,7 +621,9 @@ def matlab_delaunayn(x):
     if n < 1:
         raise ValueError('X has Low Column Number')
 
+    numPoints = x.shape[0]
     x, dupesfound, idxmap = merge_duplicate_points(x)
+    info = {'duplicatePoints': numPoints - x.shape[0], 'simplices': 0, 'zeroVolume': 0, 'belowTolerance': 0}
 
     if dupesfound:
         print('Warning: Duplicate Data Points')
@@ -505,6 +651,9 @@ def matlab_delaunayn(x):
         if dupesfound:
             t = idxmap[t]
 
+        if report:
+            info['simplices'] = 1
+            return t, info
         return t
 
     t = Delaunay(x, qhull_options="Qt Qbb Qc")  # Scipy's qhull
@@ -512,21 +661,22 @@ def matlab_delaunayn(x):
 
     # Strip the zero volume simplices that may have been created by the presence of degeneracy
     mt, nt = t.shape
-    v = np.ones(mt, dtype=bool)
+    xs = x[t]  # [mt x nt x n] vertices of each simplex
 
-    for i in range(mt):
-        xa = x[t[i, :nt - 1]]
-        xb = x[t[i, nt - 1]]
+    val = np.abs(np.linalg.det(xs[:, :nt - 1, :] - xs[:, nt - 1:, :]))
+    valtol = np.finfo(float).eps * np.max(np.abs(xs.reshape(mt, -1)), axis=1)
 
-        val = np.abs(np.linalg.det(xa - xb))
-        valtol = np.finfo(float).eps * np.max(np.abs(np.concatenate((xa.flatten(), xb.flatten()))))
+    v = val > valtol
 
-        if val <= valtol:
-            v[i] = False
+    info['simplices'] = mt
+    info['zeroVolume'] = int(np.sum(val == 0))
+    info['belowTolerance'] = int(np.sum(~v)) - info['zeroVolume']
 
     t = t[v]
 
     if dupesfound:
         t = idxmap[t]
 
+    if report:
+        return t, info
     return t
@@ -1,8 +1,18 @@
 import numpy as np
-from numpy.matlib import repmat
 
 
-def patch_normals(F, P):
+def patch_normals(F, P, return_face_data=False):
+    """
+    Vertex normals of a triangulated surface, computed as the average of the normals of the adjacent faces weighted
+    by the angle of each face at the vertex.
+
+    :param F: [M x 3] faces, as indices of P
+    :param P: [N x 3] vertices
+    :param return_face_data: If True, also return the unit face normals and the sum of the face angles at each vertex
+    :return: N: [N x 3] unit vertex normals
+             face_normals: (only if return_face_data is True) [M x 3] unit face normals, oriented as the vertex normals
+             angle_sums: (only if return_face_data is True) [N] sum of the face angles at each vertex
+    """
     Fa = F[:, 0]
     Fb = F[:, 1]
     Fc = F[:, 2]
@@ -11,41 +21,35 @@ def patch_normals(F, P):
     e2 = P[Fb, :] - P[Fc, :]
     e3 = P[Fc, :] - P[Fa, :]
 
-    e1_norm = np.divide(e1, np.transpose(
-        repmat(np.sqrt(np.square(e1[:, 0]) + np.square(e1[:, 1]) + np.square(e1[:, 2])), 3, 1)))
-    e2_norm = np.divide(e2, np.transpose(
-        repmat(np.sqrt(np.square(e2[:, 0]) + np.square(e2[:, 1]) + np.square(e2[:, 2])), 3, 1)))
-    e3_norm = np.divide(e3, np.transpose(
-        repmat(np.sqrt(np.square(e3[:, 0]) + np.square(e3[:, 1]) + np.square(e3[:, 2])), 3, 1)))
+    e1_norm = e1 / np.sqrt(np.square(e1[:, 0]) + np.square(e1[:, 1]) + np.square(e1[:, 2]))[:, np.newaxis]
+    e2_norm = e2 / np.sqrt(np.square(e2[:, 0]) + np.square(e2[:, 1]) + np.square(e2[:, 2]))[:, np.newaxis]
+    e3_norm = e3 / np.sqrt(np.square(e3[:, 0]) + np.square(e3[:, 1]) + np.square(e3[:, 2]))[:, np.newaxis]
 
-    def elementwise_dot(mat1, mat2):  # I MUST FIND A WAY TO DO THIS OPERATION FASTER. NEED TO BE VECTORIZED.
-        # mat1 and mat2 must be in same shape
-        temp_mat = np.zeros(mat1.shape[0])
-        for j in range(mat1.shape[0]):
-            temp_mat[j] = np.dot(mat1[j, :], mat2[j, :])
-        return temp_mat
+    def elementwise_dot(mat1, mat2):
+        # row-wise dot product; mat1 and mat2 must be in same shape
+        return np.einsum('ij,ij->i', mat1, mat2)
 
     angle = np.transpose(np.array([np.arccos(elementwise_dot(e1_norm, -e3_norm)),
                                    np.arccos(elementwise_dot(e2_norm, -e1_norm)),
                                    np.arccos(elementwise_dot(e3_norm, -e2_norm))]))
     normal = np.cross(e1, e3)
 
+    # Scatter the angle-weighted face normals to the vertices. np.add.at is unbuffered, so vertices shared by many
+    # faces accumulate all of them; the rows of F are raveled so that the summation order is face by face.
     vertice_normals = np.zeros((P.shape[0], 3))
-
-    for i in range(Fa.shape[0]):
-        vertice_normals[Fa[i], :] += normal[i, :] * angle[i, 0]
-        vertice_normals[Fb[i], :] += normal[i, :] * angle[i, 1]
-        vertice_normals[Fc[i], :] += normal[i, :] * angle[i, 2]
+    np.add.at(vertice_normals, F.ravel(), (normal[:, np.newaxis, :] * angle[:, :, np.newaxis]).reshape(-1, 3))
 
     epsilon = np.finfo(float).eps  # Machine epsilon
     V_norm = np.sqrt(
         np.square(vertice_normals[:, 0]) + np.square(vertice_normals[:, 1]) + np.square(
             vertice_normals[:, 2])) + epsilon
 
-    Nx = vertice_normals[:, 0] / V_norm
-    Ny = vertice_normals[:, 1] / V_norm
-    Nz = vertice_normals[:, 2] / V_norm
+    N = vertice_normals / V_norm[:, np.newaxis]
+
+    if not return_face_data:
+        return N
 
-    N = np.transpose(np.vstack((Nx, np.vstack((Ny, Nz)))))
+    face_normals = normal / (np.linalg.norm(normal, axis=1) + epsilon)[:, np.newaxis]
+    angle_sums = np.bincount(F.ravel(), weights=angle.ravel(), minlength=P.shape[0])
 
-    return N
+    return N, face_normals, angle_sums
@@ -0,0 +1,144 @@
+import sys
+import time
+import tracemalloc
+
+"""
+Structured stage timing for the clump generators, ExtractSurface and MyRobustCrust
+
+The main concept of this functionality:
+1. The caller creates a Profiler, optionally with a callback, and passes it with the optional variable "profiler".
+2. Each stage of the pipeline (load, RBP, voxelise, EDT, sphere placement, Delaunay, marking, manifold extraction,
+   export, ...) is wrapped in "with stage(profiler, name) as counts:", where counts is a dictionary the stage fills
+   with its element counts.
+3. When the stage ends, an event is recorded and passed to the callback, as a dictionary with the entries
+        stage:		name of the stage
+        parent:		name of the enclosing stage, or None
+        duration:	wall time of the stage in seconds
+        counts:		element counts of the stage (e.g. number of spheres, tetrahedrons, triangles)
+        peakMemory:	peak memory in bytes. With traceMemory=True, the peak of the memory allocated by Python and numpy
+                    during the stage, traced with tracemalloc (which slows the allocations down). Otherwise, the peak
+                    resident memory of the process so far, or None if it cannot be measured on this platform.
+4. Without a profiler (profiler=None, the default), stage returns a shared no-op context, so no time is measured and
+   no event is built.
+
+The events are plain dictionaries, so that they can be passed to the logging of the caller or dumped to .json.
+Note that the callback of a Profiler used with GenerateClump_Batch must be picklable (e.g. a module-level function),
+and that the events recorded in the worker processes are not returned to the caller.
+"""
+
+
+class Profiler:
+    def __init__(self, callback=None, traceMemory=False, keepEvents=True):
+        """
+        :param callback: Function called with each event, as soon as its stage ends
+        :param traceMemory: If True, the peak memory of each stage is traced with tracemalloc
+        :param keepEvents: If True, the events are also stored in the list profiler.events
+        """
+        self.callback = callback
+        self.traceMemory = traceMemory
+        self.keepEvents = keepEvents
+        self.events = []
+        self._stack = []  # [name, peak memory traced before the nested stages reset the peak] of the open stages
+
+    def enter(self, name):
+        if self.traceMemory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            if self._stack:
+                self._stack[-1][1] = max(self._stack[-1][1], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        self._stack.append([name, 0])
+
+    def exit(self, name, duration, counts):
+        _, peak = self._stack.pop()
+
+        if self.traceMemory:
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+            if self._stack:
+                self._stack[-1][1] = max(self._stack[-1][1], peak)
+        else:
+            peak = process_peak_memory()
+
+        event = {"stage": name, "parent": self._stack[-1][0] if self._stack else None, "duration": duration,
+                 "counts": counts, "peakMemory": peak}
+
+        if self.keepEvents:
+            self.events.append(event)
+        if self.callback is not None:
+            self.callback(event)
+
+    def summary(self):
+        """
+        :return: dictionary with the total duration and the number of events of each stage
+        """
+        summary = {}
+        for event in self.events:
+            total = summary.setdefault(event["stage"], {"duration": 0.0, "calls": 0})
+            total["duration"] += event["duration"]
+            total["calls"] += 1
+
+        return summary
+
+
+class Stage:
+    """
+    Context timing one stage of a Profiler. Entering it returns the dictionary of the element counts of the stage.
+    """
+    __slots__ = ("profiler", "name", "counts", "start")
+
+    def __init__(self, profiler, name, counts):
+        self.profiler = profiler
+        self.name = name
+        self.counts = counts
+
+    def __enter__(self):
+        self.profiler.enter(self.name)
+        self.start = time.perf_counter()
+        return self.counts
+
+    def __exit__(self, *exc):
+        self.profiler.exit(self.name, time.perf_counter() - self.start, self.counts)
+        return False
+
+
+class NullStage:
+    """
+    Context used when profiling is disabled: it does nothing.
+    """
+    __slots__ = ()
+
+    def __enter__(self):
+        return {}
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_STAGE = NullStage()
+
+
+def stage(profiler, name, **counts):
+    """
+    :param profiler: Profiler, or None to disable profiling
+    :param name: Name of the stage
+    :param counts: Element counts known when the stage starts. More can be added to the returned dictionary.
+    :return: context timing the stage
+    """
+    if profiler is None:
+        return NULL_STAGE
+
+    return Stage(profiler, name, counts)
+
+
+def process_peak_memory():
+    """
+    :return: Peak resident memory of the current process in bytes, or None if it cannot be measured on this platform
+    """
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return peak if sys.platform == "darwin" else peak * 1024  # bytes on macOS, kilobytes on Linux
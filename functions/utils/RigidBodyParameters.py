@@ -150,3 +150,54 @@ class RBP:
         return m000, m100, m010, m001, m110, m101, m011, m200, m020, m002, Inertia, V, D
 
 
+class VoxelRBP:
+    """
+    Rigid body parameters of a voxelated particle, with the same attributes as RBP. Each voxel is a cube of side
+    voxel_size centred at (index + origin) * voxel_size. Only the shape of the image is kept, so that the image can be
+    freed by the caller.
+    """
+    def __init__(self, img, voxel_size, origin=(0, 0, 0)):
+        self.shape, self.voxel_size, self.origin = img.shape, voxel_size, np.asarray(origin, dtype=float)
+        results = self.calculate_RBP(img)
+        self.moments = results[0:10]
+        self.volume = results[0]
+        self.centroid = np.array(results[1:4])/results[0]
+        self.eigs = results[-1]
+        self.PAI = results[-2]
+        self.inertia_tensor = results[-3]
+
+    def calculate_RBP(self, img):
+        # Moments accumulated slice by slice, so that only the voxel indices of one slice are in memory at once
+        dV = self.voxel_size ** 3
+        m = np.zeros(10)  # m000, m100, m010, m001, m110, m101, m011, m200, m020, m002
+        for i in range(img.shape[0]):
+            j, k = np.nonzero(img[i])
+            if j.size == 0:
+                continue
+            x = np.full(j.size, (i + self.origin[0]) * self.voxel_size)
+            y = (j + self.origin[1]) * self.voxel_size
+            z = (k + self.origin[2]) * self.voxel_size
+            m += dV * np.array([j.size, np.sum(x), np.sum(y), np.sum(z), np.sum(x * y), np.sum(x * z), np.sum(y * z),
+                                np.sum(x * x), np.sum(y * y), np.sum(z * z)])
+
+        m000, m100, m010, m001, m110, m101, m011, m200, m020, m002 = m
+
+        # Second moments of each voxel about its own centre
+        own = m000 * self.voxel_size ** 2 / 12.0
+        m200, m020, m002 = m200 + own, m020 + own, m002 + own
+
+        # % Inertia tensor ----------------------------------------------------------
+        Ixx = m020 + m002 - (m010 ** 2 + m001 ** 2) / m000
+        Iyy = m200 + m002 - (m100 ** 2 + m001 ** 2) / m000
+        Izz = m200 + m020 - (m100 ** 2 + m010 ** 2) / m000
+        Ixy = m110 - m100 * m010 / m000
+        Ixz = m101 - m100 * m001 / m000
+        Iyz = m011 - m010 * m001 / m000
+
+        Inertia = np.array([[Ixx, -Ixy, -Ixz],
+                            [-Ixy, Iyy, -Iyz],
+                            [-Ixz, -Iyz, Izz]])
+
+        V, D, _ = np.linalg.svd(Inertia)
+
+        return m000, m100, m010, m001, m110, m101, m011, m200, m020, m002, Inertia, V, D
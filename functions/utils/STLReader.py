@@ -1,55 +1,114 @@
+import os
+import re
 import numpy as np
-from stl.mesh import Mesh
 
+# Record of a triangle in a binary STL file
+STL_TRIANGLE = np.dtype([('normal', '<f4', (3,)), ('vertices', '<f4', (3, 3)), ('attr', '<u2')])
 
-def read_stl(stl_dir, is_duplicated=False):
-    # read stl files into mesh. mesh contains all the required information
-    mesh = Mesh.from_file(stl_dir)
 
-    # extract the vectors of vertices
-    P = mesh.points.reshape(-1, 3)
+def load_stl_points(stl_dir):
+    """
+    Read the vertices of all triangles of a binary or ASCII STL file.
 
-    # face enumeration
-    F = np.arange(0, P.shape[0], dtype=np.int64).reshape(mesh.points.shape[0], 3)
+    Binary files are memory-mapped as an array of triangle records, so only the vertex coordinates are read into
+    memory. ASCII files are parsed in bulk with a regular expression.
 
-    if is_duplicated:
-        return F, P
+    A file is read as binary if its size is that of its triangle count, or if it holds at least its triangle records
+    (some exporters append trailing bytes) and either its header does not start with "solid" or it cannot be parsed
+    as ASCII (some binary headers also start with "solid").
+
+    :param stl_dir: Directory of the stl file
+    :return: P: [3M x 3] float32 vertices, three per triangle
+    """
+    size = os.path.getsize(stl_dir)
+
+    count = int(np.fromfile(stl_dir, dtype='<u4', count=1, offset=80)[0]) if size >= 84 else None
+    fits = count is not None and size >= 84 + count * STL_TRIANGLE.itemsize
+
+    def read_binary():
+        triangles = np.memmap(stl_dir, dtype=STL_TRIANGLE, mode='r', offset=84, shape=(count,))
+        return np.array(triangles['vertices'], dtype=np.float32).reshape(-1, 3)
+
+    if fits and size == 84 + count * STL_TRIANGLE.itemsize:
+        return read_binary()
+
+    with open(stl_dir, 'rb') as file:
+        text = file.read()
+
+    if text.lstrip().startswith(b'solid'):
+        try:
+            vertices = re.findall(rb'vertex\s+(\S+)\s+(\S+)\s+(\S+)', text)
+            P = np.array(vertices, dtype=np.float64).astype(np.float32).reshape(-1, 3)
+        except ValueError:  # binary records matched as ASCII
+            P = None
+
+        if P is not None and (P.size or not fits):
+            return P
+
+    if fits:
+        return read_binary()
+
+    raise ValueError("Not recognised STL format.")
+
+
+def weld_vertices(P, tolerance=0):
+    """
+    Merge duplicate vertices, using a 64-bit hash of each vertex instead of a lexicographic sort of all rows.
+
+    :param P: [N x 3] vertices
+    :param tolerance: If 0, only identical vertices are merged. Otherwise, the vertices are quantised to a grid of
+                      spacing tolerance and the vertices falling in the same grid cell are merged into the first of them.
+    :return: P_unique: [U x 3] unique vertices, sorted lexicographically (same order as np.unique)
+             indices: [N] index of each vertex of P in P_unique
+    """
+    if tolerance > 0:
+        keys = np.floor(P / tolerance).astype(np.int64)
     else:
-        # now take unique values to do stl.SlimVerts.m's job
-        # it discards the common vertices to avoid duplication.
-        P_unique, indices = np.unique(P, return_inverse=True, axis=0)
+        # bit patterns of the coordinates; adding 0 turns -0.0 into 0.0, as np.unique considers them equal
+        keys = np.ascontiguousarray(P + P.dtype.type(0)).view(np.uint32 if P.dtype.itemsize == 4 else np.uint64)
 
-        F_unique = indices.reshape(-1, 3)
+    # Multiplicative hashing of the three keys into one 64-bit value
+    mixed = keys.astype(np.uint64) * np.array([0x9E3779B185EBCA87, 0xC2B2AE3D27D4EB4F, 0x165667B19E3779F9],
+                                              dtype=np.uint64)
+    hashes = mixed[:, 0] ^ (mixed[:, 1] >> np.uint64(21)) ^ mixed[:, 1] ^ (mixed[:, 2] >> np.uint64(42)) ^ mixed[:, 2]
 
-        return F_unique, P_unique
+    _, first, indices = np.unique(hashes, return_index=True, return_inverse=True)
 
+    if np.any(keys[first[indices]] != keys):  # hash collision, which is extremely unlikely
+        _, first, indices = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+        indices = indices.ravel()
 
-"""def read_stl(stl_dir, isDublicated=False):
-    # read stl files into mesh. mesh contains all the required information
-    mesh = Mesh.from_file(stl_dir)
+    # Sort the (few) unique vertices lexicographically, as np.unique would
+    P_unique = P[first]
+    order = np.lexsort((P_unique[:, 2], P_unique[:, 1], P_unique[:, 0]))
+    rank = np.empty_like(order)
+    rank[order] = np.arange(order.size)
 
-    # extract the vectors of vertices
-    # note: below can be vectorized. it is good for now.
-    P = np.zeros((mesh.points.shape[0] * 3, 3))
-    k = 0
-    for row in mesh.points:
-        P[k, :] = row[0:3]
-        P[k + 1, :] = row[3:6]
-        P[k + 2, :] = row[6:9]
-        k += 3
+    return P_unique[order], rank[indices]
 
-    # face enumeration
-    F = np.arange(0, P.shape[0]).reshape(mesh.points.shape[0], 3)  # BE CAREFUL INDEXING. IT STARTS FROM 0 NOT 1
 
-    # now take unique values to do stl.SlimVerts.m's job
-    # it discards the common vertices to avoid dublication. This can be controlled by isDublicated flag.
-    F_redefine = np.arange(0, P.shape[0])  # BE CAREFUL INDEXING. IT STARTS FROM 0 NOT 1
-    P_unique, indices = np.unique(P, return_inverse=True, axis=0)
+def read_stl(stl_dir, is_duplicated=False, tolerance=0):
+    """
+    :param stl_dir: Directory of the stl file (binary or ASCII)
+    :param is_duplicated: If True, the three vertices of each triangle are returned separately, without merging the
+                          vertices shared by several triangles
+    :param tolerance: Vertices closer than this tolerance (quantised to a grid of this spacing) are merged. If 0, only
+                      identical vertices are merged.
+    :return: F: [M x 3] faces, as indices of P
+             P: vertices
+    """
+    P = load_stl_points(stl_dir)
 
-    F_unique = F_redefine[indices]
-    F_unique = F_unique.reshape(F_unique.shape[0] // 3, 3)
+    # face enumeration
+    F = np.arange(0, P.shape[0], dtype=np.int64).reshape(-1, 3)
 
-    if isDublicated:
+    if is_duplicated:
         return F, P
     else:
-        return F_unique, P_unique"""
+        # now take unique values to do stl.SlimVerts.m's job
+        # it discards the common vertices to avoid duplication.
+        P_unique, indices = weld_vertices(P, tolerance)
+
+        F_unique = indices.reshape(-1, 3)
+
+        return F_unique, P_unique
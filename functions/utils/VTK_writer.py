@@ -2,41 +2,116 @@ import numpy as np
 import os
 
 
-def clump_to_VTK(clump, filepath=os.path.join(os.getcwd(), "spheres.vtk")):
+def clump_to_VTK(clump, filepath=os.path.join(os.getcwd(), "spheres.vtk"), binary=False):
     """
     Write sphere data to a VTK file without using external libraries.
 
+    The file format is chosen from the extension of filepath:
+    - .vtp: XML PolyData file, with the arrays stored as raw binary appended data.
+    - otherwise: legacy VTK file, in ASCII or binary form.
+
+    The arrays are written to the file clump by clump, without concatenating the clumps in memory.
+
     Parameters:
-    spheres (np.array): Numpy array containing sphere data (positions and radii).
-    output_dir (str): Directory where the VTK file will be saved.
-    filename (str): Name of the VTK file.
+    clump: Clump object (with positions and radii), or list of Clump objects to be written in the same file.
+    filepath (str): Path of the VTK file.
+    binary (bool): Whether to write a legacy VTK file in binary instead of ASCII form. Ignored for .vtp files.
+
+    Point data:
+    radius: radius of each sphere.
+    clumpID: index of the clump each sphere belongs to (only if a list of clumps is given).
     """
 
+    clumps = list(clump) if isinstance(clump, (list, tuple)) else [clump]
+    write_ids = isinstance(clump, (list, tuple))
+
+    # Count total number of spheres
+    counts = [np.asarray(c.radii).size for c in clumps]
+    number_of_spheres = int(np.sum(counts))
+
+    if filepath.endswith(".vtp"):
+        write_vtp(clumps, counts, number_of_spheres, filepath, write_ids)
+    else:
+        write_legacy(clumps, counts, number_of_spheres, filepath, write_ids, binary)
+
+
+def write_legacy(clumps, counts, number_of_spheres, filepath, write_ids, binary):
     # VTK header
     header = "# vtk DataFile Version 3.0\n"
     title = "Sphere data\n"
-    datatype = "ASCII\n"
+    datatype = "BINARY\n" if binary else "ASCII\n"
     structure = "DATASET POLYDATA\n"
 
-    clump = np.hstack((clump.positions, clump.radii))
+    def write_array(file, arrays, dtype):
+        # Legacy binary files are big-endian
+        for array in arrays:
+            if binary:
+                np.ascontiguousarray(array, dtype=">" + dtype).tofile(file)
+            elif array.ndim > 1:
+                file.write(("".join(" ".join(str(v) for v in row) + "\n" for row in array.tolist())).encode())
+            else:
+                file.write(("".join(f"{v}\n" for v in array.tolist())).encode())
+        if binary:
+            file.write(b"\n")
 
-    # Count total number of spheres
-    number_of_spheres = clump.shape[0]
+    with open(filepath, 'wb') as file:
+        file.write((header + title + datatype + structure).encode())
+
+        # Writing points
+        file.write(f"POINTS {number_of_spheres} float\n".encode())
+        write_array(file, (np.asarray(c.positions, dtype=float).reshape(-1, 3) for c in clumps), "f4")
+
+        # Writing point data (radii as scalars)
+        file.write(f"POINT_DATA {number_of_spheres}\n".encode())
+        file.write("SCALARS radius float 1\nLOOKUP_TABLE default\n".encode())
+        write_array(file, (np.asarray(c.radii, dtype=float).ravel() for c in clumps), "f4")
+
+        if write_ids:
+            file.write("SCALARS clumpID int 1\nLOOKUP_TABLE default\n".encode())
+            write_array(file, (np.full(n, i) for i, n in enumerate(counts)), "i4")
+
+
+def write_vtp(clumps, counts, number_of_spheres, filepath, write_ids):
+    # Arrays: (name, attribute, number of components, VTK type, numpy type, generator of the per-clump blocks)
+    arrays = [("radius", "PointData", 1, "Float64", "<f8", lambda: (np.asarray(c.radii).ravel() for c in clumps))]
+    if write_ids:
+        arrays.append(("clumpID", "PointData", 1, "Int32", "<i4", lambda: (np.full(n, i) for i, n in enumerate(counts))))
+    arrays += [("Points", "Points", 3, "Float64", "<f8", lambda: (np.asarray(c.positions).reshape(-1, 3) for c in clumps)),
+               ("connectivity", "Verts", 1, "Int64", "<i8", lambda: (np.arange(number_of_spheres),)),
+               ("offsets", "Verts", 1, "Int64", "<i8", lambda: (np.arange(1, number_of_spheres + 1),))]
+
+    # Offset of each array in the appended data, each one preceded by its size in bytes as a UInt64
+    offsets = []
+    offset = 0
+    for _, _, components, _, dtype, _ in arrays:
+        offsets.append(offset)
+        offset += 8 + number_of_spheres * components * np.dtype(dtype).itemsize
+
+    def data_array(i):
+        name, _, components, vtk_type, _, _ = arrays[i]
+        return (f'        <DataArray type="{vtk_type}" Name="{name}" NumberOfComponents="{components}" '
+                f'format="appended" offset="{offsets[i]}"/>\n')
 
-    # Writing points
-    points = f"POINTS {number_of_spheres} float\n"
-    for sphere in clump:
-        points += f"{sphere[0]} {sphere[1]} {sphere[2]}\n"
+    xml = ('<?xml version="1.0"?>\n'
+           '<VTKFile type="PolyData" version="1.0" byte_order="LittleEndian" header_type="UInt64">\n'
+           '  <PolyData>\n'
+           f'    <Piece NumberOfPoints="{number_of_spheres}" NumberOfVerts="{number_of_spheres}" '
+           'NumberOfLines="0" NumberOfStrips="0" NumberOfPolys="0">\n')
+    for section in ("PointData", "Points", "Verts"):
+        xml += f'      <{section}' + (' Scalars="radius"' if section == "PointData" else '') + '>\n'
+        xml += "".join(data_array(i) for i in range(len(arrays)) if arrays[i][1] == section)
+        xml += f'      </{section}>\n'
+    xml += ('    </Piece>\n'
+            '  </PolyData>\n'
+            '  <AppendedData encoding="raw">\n'
+            '   _')
 
-    # Writing point data (radii as scalars)
-    point_data = f"POINT_DATA {number_of_spheres}\n"
-    scalars = "SCALARS radius float 1\nLOOKUP_TABLE default\n"
-    for sphere in clump:
-        scalars += f"{sphere[3]}\n"
+    with open(filepath, 'wb') as file:
+        file.write(xml.encode())
 
-    # Combine sections
-    vtk_content = header + title + datatype + structure + points + point_data + scalars
+        for _, _, components, _, dtype, blocks in arrays:
+            np.array([number_of_spheres * components * np.dtype(dtype).itemsize], dtype="<u8").tofile(file)
+            for block in blocks():
+                np.ascontiguousarray(block, dtype=dtype).tofile(file)
 
-    # Write to file
-    with open(filepath, 'w') as file:
-        file.write(vtk_content)
+        file.write(b'\n  </AppendedData>\n</VTKFile>\n')
@@ -0,0 +1,144 @@
+import os
+import numpy as np
+from scipy.io import loadmat
+
+
+def load_voxels(voxel_dir, key=None, shape=None, dtype=np.uint8, offset=0, order='C'):
+    """
+    Open a voxelated image without reading it into memory when the format allows it.
+
+    - .npy files are memory-mapped.
+    - .mat files (MATLAB v5) are loaded, as they cannot be memory-mapped. MATLAB v7.3 files are HDF5 files, which are
+      read lazily with h5py if it is installed.
+    - Any other file is read as a raw binary volume of the given shape and dtype, and memory-mapped.
+
+    :param voxel_dir: Directory of the voxelated image
+    :param key: Variable of a .mat file to read. If not given, the first variable is read. The variable can be either
+                the image itself or a struct with fields {img,voxel_size}.
+    :param shape: [1 x 3] shape of a raw volume
+    :param dtype: Data type of the voxels of a raw volume
+    :param offset: Size of the header of a raw volume, in bytes
+    :param order: 'C' if the first index of a raw volume varies slowest, 'F' if it varies fastest
+    :return: img: [Nx x Ny x Nz] image (array, memory map or HDF5 dataset)
+             voxel_size: voxel size stored in the file, or None
+             transposed: True if the axes of img are reversed with respect to the image (HDF5 files written by MATLAB)
+    """
+    if voxel_dir.endswith(".npy"):
+        return np.load(voxel_dir, mmap_mode='r'), None, False
+
+    if voxel_dir.endswith(".mat"):
+        try:
+            data = loadmat(voxel_dir)
+        except NotImplementedError:  # MATLAB v7.3
+            return load_voxels_hdf5(voxel_dir, key)
+
+        # MATLAB's load function sometimes loads additional meta information starting with '__'
+        vox = data[key if key is not None else [k for k in data.keys() if not k.startswith('__')][0]]
+
+        if vox.dtype.names is not None and 'img' in vox.dtype.names:  # struct with fields {img,voxel_size}
+            voxel_size = vox['voxel_size'][0][0] if 'voxel_size' in vox.dtype.names else None
+            return vox['img'][0][0], voxel_size, False
+
+        return vox, None, False
+
+    if shape is None:
+        raise ValueError("The shape of a raw voxelated image must be given.")
+
+    expected = offset + int(np.prod(shape)) * np.dtype(dtype).itemsize
+    if os.path.getsize(voxel_dir) < expected:
+        raise ValueError(f"The raw voxelated image is smaller than {expected} bytes.")
+
+    return np.memmap(voxel_dir, dtype=dtype, mode='r', offset=offset, shape=tuple(shape), order=order), None, False
+
+
+def load_voxels_hdf5(voxel_dir, key=None):
+    try:
+        import h5py
+    except ImportError:
+        raise ImportError("Reading MATLAB v7.3 .mat files requires h5py.")
+
+    file = h5py.File(voxel_dir, 'r')
+    vox = file[key if key is not None else [k for k in file.keys() if not k.startswith('#')][0]]
+
+    if isinstance(vox, h5py.Group):  # struct with fields {img,voxel_size}
+        voxel_size = vox['voxel_size'][()] if 'voxel_size' in vox else None
+        return vox['img'], voxel_size, True
+
+    return vox, None, True
+
+
+def bounding_box(img, threshold=0):
+    """
+    Find the bounding box of the particle, reading the image in slabs along its first axis.
+
+    :param img: [Nx x Ny x Nz] image (array, memory map or HDF5 dataset)
+    :param threshold: Voxels with a value greater than threshold belong to the particle
+    :return: box: tuple of slices of the bounding box
+    """
+    step = max(1, 2 ** 26 // max(1, int(np.prod(img.shape[1:])) * np.dtype(img.dtype).itemsize))
+
+    lo = np.array(img.shape)
+    hi = np.full(3, -1)
+    for start in range(0, img.shape[0], step):
+        slab = np.asarray(img[start:start + step]) > threshold
+        if not np.any(slab):
+            continue
+
+        for axis, others in enumerate(((1, 2), (0, 2), (0, 1))):
+            indices = np.flatnonzero(np.any(slab, axis=others))
+            if axis == 0:
+                indices += start
+            lo[axis] = min(lo[axis], indices[0])
+            hi[axis] = max(hi[axis], indices[-1])
+
+    if hi[0] < 0:
+        raise ValueError("The voxelated image does not contain any particle voxel.")
+
+    return tuple(slice(start, stop + 1) for start, stop in zip(lo, hi))
+
+
+def read_voxels(voxel_dir, voxel_size=None, crop=True, threshold=0, **kwargs):
+    """
+    Read a voxelated image as a boolean array, optionally cropped to the bounding box of the particle.
+
+    The image is read in slabs, and only the cropped region is kept in memory, so memory-mapped volumes much larger
+    than the particle can be used.
+
+    :param voxel_dir: Directory of the voxelated image (.mat, .npy or raw binary volume), or [Nx x Ny x Nz] array
+    :param voxel_size: Voxel size in Cartesian space. If not given, the one stored in the file is used, or else 1.
+    :param crop: If True, the image is cropped to the bounding box of the particle
+    :param threshold: Voxels with a value greater than threshold belong to the particle
+    :param kwargs: Options of load_voxels ("key", "shape", "dtype", "offset", "order")
+    :return: img: [Nx x Ny x Nz] boolean image, True inside the particle
+             voxel_size: voxel size
+             box: tuple of slices of the returned image in the original image
+    """
+    if isinstance(voxel_dir, np.ndarray):
+        img, stored_size, transposed = voxel_dir, None, False
+    else:
+        img, stored_size, transposed = load_voxels(voxel_dir, **kwargs)
+
+    if voxel_size is None:
+        voxel_size = stored_size if stored_size is not None else 1.0
+
+    voxel_size = np.ravel(np.asarray(voxel_size, dtype=float))
+    if np.any(voxel_size != voxel_size[0]):
+        raise ValueError("Only voxelated images with the same voxel size in all 3 directions are supported.")
+    voxel_size = voxel_size[0]
+
+    if crop:
+        box = bounding_box(img, threshold)
+        particle = np.asarray(img[box]) > threshold
+    else:
+        box = tuple(slice(0, n) for n in img.shape)
+        particle = np.empty(img.shape, dtype=bool)
+        step = max(1, 2 ** 26 // max(1, int(np.prod(img.shape[1:])) * np.dtype(img.dtype).itemsize))
+        for start in range(0, img.shape[0], step):
+            particle[start:start + step] = np.asarray(img[start:start + step]) > threshold
+
+    if transposed:
+        img.file.close()
+        particle = np.ascontiguousarray(particle.T)
+        box = box[::-1]
+
+    return particle, voxel_size, box